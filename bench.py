@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from bs4 import BeautifulSoup
+
+import csdb
+from csdb import Link, get_float, get_int, get_text
+from scrape import search_ids
+import tools64
+from tools64 import Release
+
+
+def best_of(fn: Callable[[], Any], repeat: int) -> float:
+    """Best wall time in seconds of `repeat` runs of `fn`"""
+    times: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def report(name: str, secs: float, count: int, peak: int | None = None):
+    line = f"{name:>12}: {secs * 1000:8.1f}ms  {secs * 1e6 / max(count, 1):8.1f}us/item"
+    if peak is not None:
+        line += f"  {peak / 1024:8.0f}KB peak"
+    print(line)
+
+
+def peak_memory(fn: Callable[[], Any]) -> int:
+    """Most memory (in bytes) allocated at once while running `fn`"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def release_corpus(path: Path | None) -> list[bytes]:
+    """
+    Release XML from `path` (a directory of `<id>.xml`), or else everything
+    cached in the metadata store, the precache pack and `.releases/`.
+    """
+    if path is not None:
+        return [f.read_bytes() for f in sorted(path.glob("*.xml"))]
+    corpus: dict[int, bytes] = {}
+    for f in Path(".releases").glob("*.xml"):
+        if f.stem.isdigit():
+            corpus[int(f.stem)] = f.read_bytes()
+    pack = csdb.get_precache()
+    if pack is not None:
+        for kind, id, entry in pack:
+            if kind == "release":
+                corpus[id] = entry.data
+    if csdb.store.path.exists():
+        for id in csdb.store.ids("release"):
+            entry = csdb.store.get("release", id)
+            if entry is not None:
+                corpus[id] = entry.data
+    if not corpus:
+        print("No cached releases, using testdata")
+        return [Path("testdata/release.xml").read_bytes()]
+    return list(corpus.values())
+
+
+def find_parse_release(tree: ET.Element) -> Release | None:
+    """`parse_release()` as it was, one descendant search per field"""
+    release = Release()
+
+    name = tree.find("./Release/Name")
+    if name is None:
+        return None
+    release.title = name.text if name.text is not None else "?"
+    event = tree.find(".//ReleasedAt/Event")
+    if event is not None:
+        release.event = get_text(event.find("./Name"))
+    release.place = get_int(tree.find(".//Achievement/Place"))
+    release.compo = get_text(tree.find(".//Achievement/Compo"), "No Compo")
+
+    dls = tree.findall(".//DownloadLink")
+    temp: list[tuple[int, str]] = []
+    for dl in dls:
+        url = get_text(dl.find("Link"))
+        count = get_int(dl.find("Downloads"))
+        bisect.insort(temp, (count, url))
+    release.downloads = list([i[1] for i in reversed(temp)])
+    groups = tree.findall(".//ReleasedBy/Group/Name")
+    if len(groups) == 0:
+        groups = tree.findall(".//ReleasedBy/Handle/Handle")
+
+    credits = tree.findall("./Release/Credits")
+    for credit in credits:
+        credit_type = get_text(credit.find("./CreditType"))
+        handle = get_text(credit.find("./Handle"))
+        if release.composer == "" and credit_type == "Music":
+            release.composer = handle
+        elif release.coder == "" and credit_type == "Code":
+            release.coder = handle
+        if release.coder == "" and credit_type == "Graphics":
+            release.artist = handle
+
+    r = tree.find("./Release/Rating")
+    release.rating = get_float(r)
+    y = tree.find("./Release/ReleaseYear")
+    release.year = get_int(y)
+    type = tree.find("./Release/Type")
+    release.type = get_text(type)
+    gn = [n.text for n in groups if n.text is not None]
+    release.group = gn[0] if len(gn) > 0 else "Unknown"
+    release.groups = gn
+    return release
+
+
+def bench_parse(args: argparse.Namespace):
+    corpus = release_corpus(args.corpus)
+    size = sum(len(data) for data in corpus)
+    print(f"{len(corpus)} releases, {size // 1024}KB of XML")
+    trees = [ET.fromstring(data) for data in corpus]
+    for tree in trees:
+        assert csdb.parse_release(tree) == find_parse_release(tree)
+
+    report(
+        "ET parse",
+        best_of(lambda: [ET.fromstring(d) for d in corpus], args.repeat),
+        len(trees),
+    )
+    for name, parse in [("find", find_parse_release), ("walk", csdb.parse_release)]:
+        report(
+            name, best_of(lambda: [parse(t) for t in trees], args.repeat), len(trees)
+        )
+
+
+def soup_links(html: str) -> list[Link]:
+    """`get_links_from_csdb_page()` as it was, with BeautifulSoup"""
+    soup = BeautifulSoup(html, "html.parser")
+    b = soup.find("b", string="Place")
+    table = b.find_parent("table") if b else None
+    if table is None:
+        sys.exit("Could not find release table")
+
+    releases: list[Link] = []
+    ok = False
+    place = 0
+    votes = re.compile("votes")
+    for tr in table.find_all("tr"):
+        if ok:
+            d = tr.find_all("td")
+            s = d[0].text.strip()
+            if s != "":
+                place = int(s)
+            title = d[1].text
+            href = d[1].find("a").attrs["href"]
+            id = int(href.split("=")[1].strip())
+            rating = float(d[2].text.strip())
+            releases.append(Link(id, place, rating, title))
+        else:
+            ok = tr.find("b", string=votes)
+    return releases
+
+
+def soup_search(html: str) -> list[int]:
+    """`search_soup()` as it was"""
+    soup = BeautifulSoup(html, "html.parser")
+    meta = soup.find("meta", attrs={"property": "og:url"})
+    if meta is not None:
+        url = meta.attrs["content"]
+        parts = url.split("=")
+        if len(parts) > 1 and parts[0].endswith("/?id"):
+            return [int(parts[1])]
+    ol = soup.find("ol")
+    links: list[int] = []
+    if ol is not None:
+        for li in ol.find_all("li"):
+            href: str = li.find("a").attrs["href"]
+            parts = href.split("=")
+            if parts[1].isdigit():
+                links.append(int(parts[1]))
+    return links
+
+
+def bench_pages(
+    pages: list[Path], parsers: list[tuple[str, Callable[[str], Any]]], repeat: int
+):
+    for page in pages:
+        html = page.read_text()
+        results = [parse(html) for _, parse in parsers]
+        assert all(r == results[0] for r in results)
+        print(f"{page}: {len(html) // 1024}KB, {len(results[0])} results")
+        for name, parse in parsers:
+            secs = best_of(lambda: parse(html), repeat)
+            report(name, secs, len(results[0]), peak_memory(lambda: parse(html)))
+
+
+def bench_toplist(args: argparse.Namespace):
+    def event_links(html: str) -> list[Link]:
+        return csdb.get_links_from_csdb_page(html)[0]
+
+    parsers = [("soup", soup_links), ("events", event_links)]
+    bench_pages(args.pages, parsers, args.repeat)
+
+
+def bench_search(args: argparse.Namespace):
+    def event_search(html: str) -> list[int]:
+        # `search_page()` without the printing
+        single, ids, _ = search_ids(html)
+        return [single] if single is not None else ids
+
+    parsers = [("soup", soup_search), ("events", event_search)]
+    bench_pages(args.pages, parsers, args.repeat)
+
+
+def extract_native(archive: Path, out: Path):
+    if archive.suffix.upper() == ".GZ":
+        tools64.gunzip(archive, out / archive.stem)
+    else:
+        tools64.native_formats[archive.suffix.upper()](archive, out)
+
+
+def extract_external(archive: Path, out: Path):
+    ext = archive.suffix.upper()
+    if ext == ".GZ":
+        shutil.copyfile(archive, out / archive.name)
+        subprocess.call(["gzip", "-d", out / archive.name])
+    elif ext == ".ZIP" and shutil.which("7z") is None:
+        # Close enough when 7z is not installed
+        subprocess.call(["unzip", "-q", "-o", "-j", archive, "-d", out])
+    else:
+        tools64.extract_with_tool(archive, ext, out)
+
+
+def bench_unpack(args: argparse.Namespace):
+    archives: list[Path] = args.archives or [
+        *sorted(Path("testdata").glob("*.zip")),
+        Path("testdata/SPACEACA.T64.gz"),
+    ]
+    for archive in archives:
+        print(f"{archive}: {archive.stat().st_size // 1024}KB")
+        times: list[float] = []
+        for name, extract in [("tool", extract_external), ("native", extract_native)]:
+
+            def run():
+                with tempfile.TemporaryDirectory() as out:
+                    extract(archive, Path(out))
+
+            times.append(best_of(run, args.repeat))
+            report(name, times[-1], 1)
+        print(f"{'speedup':>12}: {times[0] / times[1]:8.1f}x")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        prog="bench",
+        description="Benchmarks of csdbspider internals, on cached data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    arg_parser.add_argument("-r", "--repeat", default=5, type=int, help="Runs per test")
+    sub = arg_parser.add_subparsers(required=True)
+
+    p = sub.add_parser("parse", help="Release XML to Release")
+    p.add_argument("corpus", nargs="?", type=Path, help="Directory of release XML")
+    p.set_defaults(func=bench_parse)
+
+    p = sub.add_parser("toplist", help="Top list page to Links")
+    p.add_argument(
+        "pages",
+        nargs="*",
+        type=Path,
+        default=[Path("testdata/toplist.html")],
+        help="Saved top list pages",
+    )
+    p.set_defaults(func=bench_toplist)
+
+    p = sub.add_parser("search", help="Search result page to ids")
+    p.add_argument(
+        "pages",
+        nargs="*",
+        type=Path,
+        default=[Path("testdata/oxyron.html"), Path("testdata/crackers.html")],
+        help="Saved search result pages",
+    )
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("unpack", help="Extracting archives, native vs tools")
+    p.add_argument("archives", nargs="*", type=Path, help="Zip, tar or gz files")
+    p.set_defaults(func=bench_unpack)
+
+    args = arg_parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections.abc import Generator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+import csdb
+import utils
+from utils import DirIndex, Journal
+
+file_data = bytes(range(256)) * 40
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    busy = 0
+    ranges: list[str] = []
+    xml_version = 1
+    xml_requests = 0
+
+    def do_GET(self):
+        if self.path == "/busy" and Handler.busy > 0:
+            Handler.busy -= 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path.startswith("/webservice/"):
+            Handler.xml_requests += 1
+            if "&id=404&" in self.path:
+                self.send_error(404)
+                return
+            etag = f'"{Handler.xml_version}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = (
+                "<CSDbData><Group><ID>1</ID>"
+                f"<Name>Version {Handler.xml_version}</Name></Group></CSDbData>"
+            ).encode()
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path in ("/redirect", "/busy"):
+            self.send_response(302)
+            self.send_header("Location", "/data")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/data":
+            body = b"x" * 1000
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path in ("/file.zip", "/slow.zip", "/other.zip"):
+            if self.path == "/slow.zip":
+                time.sleep(1)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(file_data)))
+            self.end_headers()
+            self.wfile.write(file_data)
+        elif self.path == "/short.zip":
+            # Connection dies half way through the file
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(file_data)))
+            self.end_headers()
+            self.wfile.write(file_data[:1000])
+            self.close_connection = True
+        elif self.path == "/stall":
+            # Stops sending half way through the body
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b"x" * 500)
+            self.wfile.flush()
+            time.sleep(1)
+            self.close_connection = True
+        elif self.path in ("/flaky.zip", "/norange.zip"):
+            # Dies half way unless resumed with a range request
+            rng = self.headers.get("Range")
+            if rng is not None and self.path == "/flaky.zip":
+                Handler.ranges.append(rng)
+                start = int(rng[6:-1])
+                self.send_response(206)
+                self.send_header("Content-Length", str(len(file_data) - start))
+                self.send_header(
+                    "Content-Range",
+                    f"bytes {start}-{len(file_data)-1}/{len(file_data)}",
+                )
+                self.end_headers()
+                self.wfile.write(file_data[start:])
+            else:
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(file_data)))
+                self.end_headers()
+                self.wfile.write(file_data[:1000])
+                self.close_connection = True
+        else:
+            self.send_error(404)
+
+    def log_message(self, format: str, *args: object):
+        pass
+
+
+@pytest.fixture
+def server() -> Generator[str, None, None]:
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    t = threading.Thread(target=httpd.serve_forever, daemon=True)
+    t.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def cache_state(monkeypatch: pytest.MonkeyPatch):
+    """Cache state is loaded on first use; don't share it between tests"""
+    monkeypatch.setattr(utils, "downloads", Journal(Path("releases/.downloads")))
+    monkeypatch.setattr(utils, "cached_files", DirIndex(Path("releases")))
+    monkeypatch.setattr(utils, "pinned", set())
+    monkeypatch.setattr(utils, "failures", Journal(Path("releases/.failed")))
+    monkeypatch.setattr(utils, "retry_window", 7 * 86400)
+    monkeypatch.setattr(csdb, "legacy_dirs", {})
@@ -1,22 +1,43 @@
 #!/usr/bin/env python3
 import argparse
-import bisect
-import re
-import subprocess
+import itertools
+import json
+import queue
 import sys
+import threading
+import time
 import urllib.error
 import urllib.parse
-import urllib.request
 import xml.etree.ElementTree as ET
-from dataclasses import dataclass, field
+from collections import Counter, deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from shutil import which
-from typing import Callable
-
-from bs4 import BeautifulSoup, Tag
-
-from tools64 import Release, unpack, show_run_output
-from utils import download, get_cached
+from typing import Any, Callable
+
+from net import session
+from precache import Pack, append_pack, write_pack
+from replay import FixtureStore
+from scrape import search_ids, toplist_rows
+from store import Entry, MetaStore
+from tools64 import Release, check_archive, run, show_run_output, unpack
+from utils import (
+    DirIndex,
+    cache_file,
+    collect_garbage,
+    download,
+    failed_recently,
+    format_size,
+    get_cached,
+    hedged_download,
+    mark_failed,
+    parse_age,
+    parse_size,
+    pin,
+    recent_failure,
+    set_retry_window,
+)
 
 
 @dataclass
@@ -41,107 +62,319 @@ class Event:
 
 types: dict[str, int] = {"demo": 1, "onefile": 2, "game": 3}
 
+csdb_url = "https://csdb.dk"
+
+# Bump this when `parse_release()` changes, to not use releases parsed before
+parser_version = 1
+
+# How long (in seconds) scraped CSDb pages are cached, per kind of page
+page_ttl: dict[str, float] = {"search": 7 * 86400, "toplist": 86400}
+refresh_pages = False
+
+# Max age in seconds of cached metadata before it is checked for updates
+revalidate_age: float | None = None
+
+store = MetaStore(Path(".metadata.sqlite"))
+
+precache_file = Path("data/precache.pack")
+precache: Pack | None = None
+
+# Stored for ids that CSDb doesn't know about
+missing_xml = b"<CSDbData/>"
+
+# Old style metadata cache directories (`.releases/` etc)
+legacy_dirs: dict[str, DirIndex] = {}
 
-def get_soup(url: str) -> BeautifulSoup:
+xml_lock = threading.Lock()
+revalidated: Counter[str] = Counter()
+
+
+def get_html(url: str) -> str:
     try:
-        data: bytes = urllib.request.urlopen(url).read()
-        doc = data.decode()
-        return BeautifulSoup(doc, "html.parser")
+        data: bytes = session.fetch(url)
+        return data.decode()
     except urllib.error.URLError as e:
         print(f"**Eror: Can not download from CSDb: {e.reason}")
         sys.exit(1)
 
 
-def get_groups() -> list[tuple[str, int]]:
-    result: list[tuple[str, int]] = []
-    soup = get_soup(r"https://csdb.dk/toplist.php?type=group&subtype=(1)")
-    links = get_links_from_csdb_page(soup)
-    for link in links:
-        result.append((link.name, link.id))
-    return result
+def set_refresh_pages(refresh: bool):
+    """Scrape search results and top lists again even if they are cached"""
+    global refresh_pages
+    refresh_pages = refresh
 
 
-def search(what: str, text: str) -> list[int]:
-    text = urllib.parse.quote(text)
-    soup = get_soup(rf"https://csdb.dk/search/?seinsel={what}&search={text}")
-    return search_soup(soup)
-
-
-def search_soup(soup: BeautifulSoup) -> list[int]:
-    meta = soup.find("meta", attrs={"property": "og:url"})
-    if isinstance(meta, Tag):
-        url = meta.attrs["content"]
-        assert isinstance(url, str)
-        parts = url.split("=")
-        if len(parts) > 1 and parts[0].endswith("/?id"):
-            print("Got single id in result")
-            return [int(parts[1])]
-    ol = soup.find("ol")
-    links: list[int] = []
-
-    if isinstance(ol, Tag):
-        for li in ol.find_all("li"):
-            href: str = li.find("a").attrs["href"]
-            parts = href.split("=")
-            if parts[1].isdigit():
-                links.append(int(parts[1]))
-    return links
+def get_page(kind: str, key: str, scrape: Callable[[], Any]) -> Any:
+    """
+    Get what `scrape` extracts from a CSDb page, from the store unless it
+    is older than the TTL for `kind`.
+    """
+    cached = store.get_page(kind, key)
+    if (
+        cached is not None
+        and not refresh_pages
+        and time.time() - cached[1] < page_ttl[kind]
+    ):
+        return json.loads(cached[0])
+    result = scrape()
+    store.put_page(kind, key, time.time(), json.dumps(result))
+    return result
 
 
-def get_toplist_releases(what: str) -> list[Link]:
-    if what in types.keys():
-        t = types[what]
-        url = rf"https://csdb.dk/toplist.php?type=release&subtype=({t})"
+def get_pages(
+    kind: str, key: str, url: str, scrape: Callable[[str], tuple[Any, str | None]]
+) -> Iterator[Any]:
+    """
+    What `scrape` extracts from each page of a list on CSDb, starting at
+    `url`. `scrape` gets the HTML of a page and returns what it found and
+    the URL of the next page (if any). The next page is fetched in the
+    background while the caller is busy with the current one. A page is
+    never fetched twice, so links back to an earlier page end the list.
+    """
+
+    def get(n: int, url: str) -> dict[str, Any]:
+        def scrape_page() -> dict[str, Any]:
+            result, next = scrape(get_html(url))
+            if next is not None:
+                next = urllib.parse.urljoin(url, next)
+            return {"result": result, "next": next}
+
+        return get_page(kind, f"{key}@{n}", scrape_page)
+
+    pool = ThreadPoolExecutor(max_workers=1)
+    seen = {url}
+    try:
+        n = 1
+        page = get(n, url)
+        while True:
+            next = page["next"]
+            if next in seen:
+                next = None
+            future = None
+            if next is not None:
+                seen.add(next)
+                future = pool.submit(get, n + 1, next)
+            yield page["result"]
+            if future is None:
+                return
+            n += 1
+            page = future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def toplist_pages(what: str) -> Iterator[list[Link]]:
+    """The top list for a type of release (or "group"), a page at a time"""
+    if what == "group":
+        url = rf"{csdb_url}/toplist.php?type=group&subtype=(1)"
+    elif what in types.keys():
+        url = rf"{csdb_url}/toplist.php?type=release&subtype=({types[what]})"
     else:
         raise NameError
-    soup = get_soup(url)
-    return get_links_from_csdb_page(soup)
+
+    def scrape(html: str) -> tuple[list[dict[str, Any]], str | None]:
+        links, next = get_links_from_csdb_page(html)
+        return [asdict(link) for link in links], next
+
+    for page in get_pages("toplist", what, url, scrape):
+        yield [Link(**link) for link in page]
+
+
+def toplist_links(what: str) -> Iterator[Link]:
+    for page in toplist_pages(what):
+        yield from page
+
+
+def get_groups(count: int) -> list[tuple[str, int]]:
+    """The first `count` groups of the group top list"""
+    links = itertools.islice(toplist_links("group"), count)
+    return [(link.name, link.id) for link in links]
+
+
+def search_pages(what: str, text: str) -> Iterator[list[int]]:
+    """Ids found by a CSDb search, a page at a time"""
+    query = urllib.parse.quote(text)
+    url = rf"{csdb_url}/search/?seinsel={what}&search={query}"
+    seen: set[int] = set()
+    for ids in get_pages("search", f"{what}/{text}", url, search_page):
+        # Later pages may repeat what was on the first one
+        new = [id for id in ids if id not in seen]
+        seen.update(new)
+        yield new
+
+
+def search(what: str, text: str) -> Iterator[int]:
+    for page in search_pages(what, text):
+        yield from page
+
+
+def index_names():
+    """Make sure names in all cached and precached metadata are indexed"""
+    pack = get_precache()
+    if pack is not None:
+        st = precache_file.stat()
+        data = (entry.data for _, _, entry in pack)
+        if store.index_names("precache", f"{st.st_size}/{st.st_mtime}", data):
+            print(f"Indexed names in {precache_file}")
+    for what in ("release", "group", "event"):
+        path = Path(f".{what}s")
+        if path.is_dir():
+            data = (f.read_bytes() for f in path.glob("*.xml"))
+            store.index_names(str(path), str(path.stat().st_mtime), data)
+
+
+def find_ids(what: str, name: str) -> Iterable[int]:
+    """
+    Ids of groups or events (`what`) called `name`. Names are looked up
+    in cached metadata first, and only searched for on CSDb if not found.
+    """
+    index_names()
+    ids = store.find_name(what, name)
+    if len(ids) > 0:
+        print(f"Found {len(ids)} {what}(s) matching '{name}' in cached metadata")
+        return ids
+    similar = store.similar_names(what, name)
+    if similar:
+        names = ", ".join(f"'{n}'" for n in similar)
+        print(f"No {what} '{name}' in cached metadata (similar: {names})")
+    return search(f"{what}s", name)
+
+
+def search_page(html: str) -> tuple[list[int], str | None]:
+    single, ids, next = search_ids(html)
+    if single is not None:
+        print("Got single id in result")
+        return [single], None
+    return ids, next
+
+
+def get_toplist_releases(what: str) -> list[Link]:
+    return list(toplist_links(what))
 
 
-def get_links_from_csdb_page(soup: BeautifulSoup) -> list[Link]:
-    # Find starting table
-    b = soup.find("b", string="Place")
-    table = b.find_parent("table") if b else None
-    if table is None:
+def get_links_from_csdb_page(html: str) -> tuple[list[Link], str | None]:
+    rows, next = toplist_rows(html)
+    if rows is None:
         sys.exit("Could not find release table")
 
     releases: list[Link] = []
-    ok = False
     place = 0
-    votes = re.compile("votes")
-    for tr in table.find_all("tr"):
-        if ok:
-            d = tr.find_all("td")
-            s = d[0].text.strip()
-            if s != "":
-                place = int(s)
-            title = d[1].text
-            href = d[1].find("a").attrs["href"]
-            id = int(href.split("=")[1].strip())
-            rating = float(d[2].text.strip())
-            releases.append(Link(id, place, rating, title))
+    for d in rows:
+        s = d[0][0].strip()
+        if s != "":
+            place = int(s)
+        title, href = d[1]
+        assert href is not None
+        id = int(href.split("=")[1].strip())
+        rating = float(d[2][0].strip())
+        releases.append(Link(id, place, rating, title))
+    return releases, next
+
+
+def set_revalidate(age: float | None):
+    """Check cached metadata older than `age` seconds for updates"""
+    global revalidate_age
+    revalidate_age = age
+
+
+def needs_revalidate(fetched: float) -> bool:
+    if revalidate_age is None:
+        return False
+    return time.time() - fetched >= revalidate_age
+
+
+def get_precache() -> Pack | None:
+    global precache
+    with xml_lock:
+        if precache is None and precache_file.exists():
+            precache = Pack(precache_file)
+        return precache
+
+
+def legacy_dir(what: str) -> DirIndex:
+    with xml_lock:
+        if what not in legacy_dirs:
+            legacy_dirs[what] = DirIndex(Path(f".{what}s"))
+        return legacy_dirs[what]
+
+
+def get_cached_xml(what: str, id: int) -> Entry | None:
+    """
+    Get cached xml from the store, the precache pack or an old style
+    cache directory.
+    """
+    entry = store.get(what, id)
+    pack = get_precache()
+    if entry is None and pack is not None:
+        entry = pack.get(what, id)
+    if entry is None and f"{id}.xml" in legacy_dir(what):
+        p = Path(f".{what}s") / f"{id}.xml"
+        entry = Entry(p.read_bytes(), p.stat().st_mtime)
+        store.put(what, id, entry)
+    return entry
+
+
+def fetch_csdb_xml(url: str, what: str, id: int, cached: Entry | None) -> Entry:
+    """
+    Fetch `url` into the store. If we have `cached` data, the request is
+    made conditional and the store is only updated if the data changed.
+    """
+    headers: dict[str, str] = {}
+    if cached is not None:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.modified:
+            headers["If-Modified-Since"] = cached.modified
+    with session.open(url, headers) as resp:
+        if resp.status == 304 and cached is not None:
+            data = cached.data
         else:
-            ok = tr.find("b", string=votes)
-    return releases
-
-
-def get_csdb_xml(what: str, id: int, depth: int = 2):
-    cache = Path(f".{what}s")
-    cache.mkdir(parents=True, exist_ok=True)
-    p = cache / f"{id}.xml"
-    if p.exists():
-        text: str = p.read_text()
-    else:
-        url = rf"https://csdb.dk/webservice/?type={what}&id={id}&depth={depth}"
+            data = resp.read()
+        etag = resp.headers.get("ETag")
+        entry = Entry(data, time.time(), etag, resp.headers.get("Last-Modified"))
+    if cached is None:
+        store.put(what, id, entry)
+        return entry
+    with xml_lock:
+        revalidated["checked"] += 1
+        revalidated["changed"] += data != cached.data
+    if resp.status == 304 or data == cached.data:
+        cached.fetched = entry.fetched
+        if not store.touch(what, id, entry.fetched):
+            # Came from the precache
+            store.put(what, id, cached)
+        return cached
+    store.put(what, id, entry)
+    return entry
+
+
+def get_csdb_entry(what: str, id: int, depth: int = 2) -> Entry:
+    """Get webservice XML from the cache, fetching it if needed"""
+    entry = get_cached_xml(what, id)
+    if (
+        entry is None
+        or needs_revalidate(entry.fetched)
+        or (entry.data == missing_xml and not failed_recently(entry.fetched))
+    ):
+        url = rf"{csdb_url}/webservice/?type={what}&id={id}&depth={depth}"
         try:
-            data: bytes = urllib.request.urlopen(url).read()
+            entry = fetch_csdb_xml(url, what, id, entry)
         except ValueError:
             sys.exit(f"Illegal URL: {url}")
-        except (urllib.error.HTTPError, urllib.error.URLError):
-            sys.exit(f"Network error for {url}")
-        text: str = data.decode("utf-8")
-        p.write_text(text)
-    tree = ET.fromstring(text)
+        except (urllib.error.HTTPError, urllib.error.URLError) as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code == 404:
+                print(f"No {what} {id} on CSDb")
+                entry = Entry(missing_xml, time.time())
+                store.put(what, id, entry)
+            elif entry is None:
+                sys.exit(f"Network error for {url}")
+            else:
+                print(f"Network error for {url}, using cached data")
+    return entry
+
+
+def get_csdb_xml(what: str, id: int, depth: int = 2):
+    tree = ET.fromstring(get_csdb_entry(what, id, depth).data)
     return tree
 
 
@@ -200,33 +433,85 @@ def get_group_releases(id: int) -> list[Link]:
 
 
 def populate_release(link: Link) -> Release | None:
-    """Use CSDb webservice to populate Release struct"""
-    release = Release(link.id, link.place, link.rating, link.name)
+    """
+    Use CSDb webservice to populate Release struct. Parsed releases are
+    kept in the store, so the XML only needs to be parsed again when it
+    changes, or when `parser_version` is bumped.
+    """
+    parsed = store.get_parsed(link.id, parser_version)
+    if parsed is not None and not needs_revalidate(parsed[1]):
+        fields: dict[str, Any] | None = json.loads(parsed[0])
+    else:
+        entry = get_csdb_entry("release", link.id)
+        if entry.data == missing_xml:
+            return None
+        rel = parse_release(ET.fromstring(entry.data))
+        fields = asdict(rel) if rel is not None else None
+        data = json.dumps(fields, separators=(",", ":"))
+        store.put_parsed(link.id, parser_version, entry.fetched, data)
+    if fields is None:
+        return None
+    release = Release(**fields)
+    release.id = link.id
+    release.rank = link.place
+    return release
 
-    tree = get_csdb_xml("release", link.id)
+
+def parse_release(tree: ET.Element) -> Release | None:
+    """
+    Get Release fields from webservice XML. The document is walked once,
+    picking up everything that lives below the top level release (event,
+    achievement, download links and groups) as it goes.
+    """
+    release = Release()
 
     name = tree.find("./Release/Name")
     if name is None:
         return None
     release.title = name.text if name.text is not None else "?"
-    event = tree.find(".//ReleasedAt/Event")
+
+    credits: list[ET.Element] = []
+    fields: dict[str, ET.Element] = {}
+    for rel in tree.iterfind("./Release"):
+        for elem in rel:
+            if elem.tag == "Credits":
+                credits.append(elem)
+            else:
+                fields.setdefault(elem.tag, elem)
+
+    event: ET.Element | None = None
+    place: ET.Element | None = None
+    compo: ET.Element | None = None
+    temp: list[tuple[int, str]] = []
+    groups: list[ET.Element] = []
+    handles: list[ET.Element] = []
+    for elem in tree.iter():
+        tag = elem.tag
+        if tag == "DownloadLink":
+            url = get_text(elem.find("Link"))
+            count = get_int(elem.find("Downloads"))
+            temp.append((count, url))
+        elif tag == "ReleasedBy":
+            for by in elem:
+                if by.tag == "Group":
+                    groups += by.iterfind("Name")
+                elif by.tag == "Handle":
+                    handles += by.iterfind("Handle")
+        elif tag == "Achievement":
+            if place is None:
+                place = elem.find("Place")
+            if compo is None:
+                compo = elem.find("Compo")
+        elif tag == "ReleasedAt" and event is None:
+            event = elem.find("Event")
+
     if event is not None:
         release.event = get_text(event.find("./Name"))
-    release.place = get_int(tree.find(".//Achievement/Place"))
-    release.compo = get_text(tree.find(".//Achievement/Compo"), "No Compo")
+    release.place = get_int(place)
+    release.compo = get_text(compo, "No Compo")
+    temp.sort(reverse=True)
+    release.downloads = [url for _, url in temp]
 
-    dls = tree.findall(".//DownloadLink")
-    temp: list[tuple[int, str]] = []
-    for dl in dls:
-        url = get_text(dl.find("Link"))
-        count = get_int(dl.find("Downloads"))
-        bisect.insort(temp, (count, url))
-    release.downloads = list([i[1] for i in reversed(temp)])
-    groups = tree.findall(".//ReleasedBy/Group/Name")
-    if len(groups) == 0:
-        groups = tree.findall(".//ReleasedBy/Handle/Handle")
-
-    credits = tree.findall("./Release/Credits")
     for credit in credits:
         credit_type = get_text(credit.find("./CreditType"))
         handle = get_text(credit.find("./Handle"))
@@ -237,21 +522,66 @@ def populate_release(link: Link) -> Release | None:
         if release.coder == "" and credit_type == "Graphics":
             release.artist = handle
 
-
-    r = tree.find("./Release/Rating")
-    release.rating = get_float(r)
-    y = tree.find("./Release/ReleaseYear")
-    release.year = get_int(y)
-    type = tree.find("./Release/Type")
-    release.type = get_text(type)
-    gn = [n.text for n in groups if n.text is not None]
+    release.rating = get_float(fields.get("Rating"))
+    release.year = get_int(fields.get("ReleaseYear"))
+    release.type = get_text(fields.get("Type"))
+    gn = [n.text for n in (groups or handles) if n.text is not None]
     release.group = gn[0] if len(gn) > 0 else "Unknown"
     release.groups = gn
     return release
 
 
-def unpack_to(file: Path, target_dir: Path, to_prg: bool):
-    udir = Path("_unpack")
+def iter_releases(
+    links: Iterable[Link],
+    accept: Callable[[Link, Release], bool],
+    max_rel: int,
+    jobs: int = 8,
+) -> Iterator[Release]:
+    """
+    Populate releases from `links` using `jobs` concurrent workers, and
+    yield the accepted ones.
+
+    Results are consumed in link order, so releases come out in the same
+    order as when populating one link at a time. No more work is scheduled
+    once `max_rel` releases have been accepted.
+    """
+    count = 0
+    todo = iter(links)
+    pending: deque[tuple[Link, Future[Release | None]]] = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+
+        def schedule():
+            while len(pending) < jobs * 2:
+                link = next(todo, None)
+                if link is None:
+                    break
+                pending.append((link, pool.submit(populate_release, link)))
+
+        try:
+            schedule()
+            while pending and count < max_rel:
+                link, future = pending.popleft()
+                rel = future.result()
+                if rel is not None and accept(link, rel):
+                    count += 1
+                    yield rel
+                if count < max_rel:
+                    schedule()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def populate_releases(
+    links: Iterable[Link],
+    accept: Callable[[Link, Release], bool],
+    max_rel: int,
+    jobs: int = 8,
+) -> list[Release]:
+    return list(iter_releases(links, accept, max_rel, jobs))
+
+
+def unpack_to(file: Path, target_dir: Path, to_prg: bool, udir: Path = Path("_unpack")):
     if target_dir.is_dir():
         for r in target_dir.iterdir():
             r.unlink()
@@ -263,57 +593,157 @@ def unpack_to(file: Path, target_dir: Path, to_prg: bool):
     return False
 
 
-def download_releases(releases: list[Release], template: str, to_prg: bool):
-    for release in releases:
-        target_dir = Path(release.format(template))
-        target_dir.mkdir(parents=True, exist_ok=True)
-        # print(target_dir)
-        ok = False
+def fetch_release(release: Release, hedge: float | None = None) -> list[Path]:
+    """
+    Get the archives to try for `release`; all cached ones, or if there are
+    none the first one we manage to download.
+    """
+    files: list[Path] = []
+    for dl in release.downloads:
+        pin(dl)
+        file = get_cached(dl)
+        if file is not None and recent_failure(dl) is None:
+            files.append(file)
+    if len(files) > 0:
+        return files
+    if hedge is not None:
+        file = hedged_download(release.downloads, hedge, check_archive)
+        return [file] if file is not None else []
+    for dl in release.downloads:
+        file = download(dl)
+        if file is not None:
+            return [file]
+    return []
+
+
+def unpack_release(
+    release: Release,
+    files: list[Path],
+    target_dir: Path,
+    to_prg: bool,
+    udir: Path,
+    hedge: float | None = None,
+) -> bool:
+    """
+    Unpack the first good archive of `files` into `target_dir`. If none
+    of them are good, go on trying the rest of the release downloads.
+    """
+    urls = {cache_file(dl): dl for dl in release.downloads}
+
+    def try_unpack(file: Path) -> bool:
+        if unpack_to(file, target_dir, to_prg, udir):
+            return True
+        # A good archive may just need a tool we don't have; keep those
+        if check_archive(file):
+            mark_failed(urls[file], "Nothing to unpack")
+        else:
+            mark_failed(urls[file], "Not an archive")
+        return False
 
-        for dl in release.downloads:
-            file = get_cached(dl)
-            if file is not None:
-                if unpack_to(file, target_dir, to_prg):
-                    ok = True
-                    break
-        if ok:
-            continue
-        for dl in release.downloads:
-            file = download(dl)
-            if file is not None:
-                if unpack_to(file, target_dir, to_prg):
-                    ok = True
-                    break
-        if not ok:
-            print(f"Found no valid download for {release.group} - {release.title}")
+    target_dir.mkdir(parents=True, exist_ok=True)
+    for file in files:
+        if try_unpack(file):
+            return True
+    rest = [dl for dl in release.downloads if cache_file(dl) not in files]
+    if hedge is not None:
+        return hedged_download(rest, hedge, try_unpack) is not None
+    for dl in rest:
+        file = download(dl)
+        if file is not None:
+            if try_unpack(file):
+                return True
+    return False
+
+
+def download_releases(
+    releases: Iterable[Release],
+    template: str,
+    to_prg: bool,
+    hedge: float | None = None,
+    download_jobs: int = 1,
+    unpack_jobs: int = 1,
+) -> int:
+    """
+    Download and unpack `releases` as a pipeline; `download_jobs` threads
+    fetch archives while `unpack_jobs` threads unpack them. The queues
+    between the stages are bounded, so only a few releases are in flight at
+    any time, and `releases` can be a generator still populating them.
+
+    Returns the number of releases successfully unpacked.
+    """
+    to_download: queue.Queue[Release | None] = queue.Queue(download_jobs * 2)
+    to_unpack: queue.Queue[tuple[Release, list[Path]] | None] = queue.Queue(
+        unpack_jobs * 2
+    )
+    target_locks: dict[Path, threading.Lock] = {}
+    lock = threading.Lock()
+    unpacked = 0
+
+    def downloader():
+        while (release := to_download.get()) is not None:
+            files: list[Path] = []
+            try:
+                files = fetch_release(release, hedge)
+            except Exception as e:
+                print(f"**Error: Downloading {release.title} failed: {e}")
+            to_unpack.put((release, files))
+
+    def unpacker(udir: Path):
+        nonlocal unpacked
+        while (item := to_unpack.get()) is not None:
+            release, files = item
+            target_dir = Path(release.format(template))
+            with lock:
+                target_lock = target_locks.setdefault(target_dir, threading.Lock())
+            ok = False
+            try:
+                with target_lock:
+                    ok = unpack_release(release, files, target_dir, to_prg, udir, hedge)
+            except Exception as e:
+                print(f"**Error: Unpacking {release.title} failed: {e}")
+            if ok:
+                with lock:
+                    unpacked += 1
+            else:
+                print(f"Found no valid download for {release.group} - {release.title}")
+
+    downloaders = [threading.Thread(target=downloader) for _ in range(download_jobs)]
+    unpackers = [
+        threading.Thread(target=unpacker, args=(Path(f"_unpack{i}"),))
+        for i in range(unpack_jobs)
+    ]
+    for t in downloaders + unpackers:
+        t.start()
+    try:
+        for release in releases:
+            to_download.put(release)
+    finally:
+        for _ in downloaders:
+            to_download.put(None)
+        for t in downloaders:
+            t.join()
+        for _ in unpackers:
+            to_unpack.put(None)
+        for t in unpackers:
+            t.join()
+    return unpacked
 
 
 def unpack_precache():
+    """
+    Unpack old style 7z precache archives. Not needed (and not done) if
+    there is a precache pack, since that is read directly.
+    """
+    if precache_file.exists():
+        return
     rels = Path("data/releases.7z")
     groups = Path("data/groups.7z")
     if not Path(".releases").exists() and rels.exists():
         print("Unpacking precached release data")
-        return subprocess.call(["7z", "x", rels], stdout=subprocess.DEVNULL)
+        run(["7z", "x", rels])
     if not Path(".groups").exists() and groups.exists():
         print("Unpacking precached group data")
-        return subprocess.call(["7z", "x", groups], stdout=subprocess.DEVNULL)
-
-
-def check(tool: str, msg: str) -> bool:
-    if which(tool) is None:
-        print(f"**Missing** `{tool}`. {msg}")
-        return False
-    return True
-
-
-def check_tools() -> bool:
-    return (
-        check("7z", "You need it to unpack (and repack) archives")
-        and check("cbmconvert", "You need it to convert C64 file formats")
-        and check("zip2disk", "You need it to convert C64-zip to d64")
-        and check("unrar", "You need it to unpack rar files")
-        # and check("lha", "You need it to unpack lha and lhx files")
-    )
+        run(["7z", "x", groups])
 
 
 def log(txt: str):
@@ -340,6 +770,96 @@ def filter_none(rwel: Release):
     return False
 
 
+def collect_cache(max_size: int | None):
+    removed, freed, left = collect_garbage(max_size)
+    print(
+        f"Removed {removed} files from releases/, freeing {format_size(freed)}"
+        f" ({format_size(left)} left)"
+    )
+
+
+def popular_ids(top_groups: int) -> dict[str, set[int]]:
+    """
+    Ids of the groups in the top `top_groups` of the group top list, their
+    releases and the releases on the release top lists, and the events all
+    these were released at. Releases and events are taken from the store.
+    """
+    groups = {id for _, id in get_groups(top_groups)}
+    releases = {link.id for what in types for link in get_toplist_releases(what)}
+    for id in groups:
+        entry = store.get("group", id)
+        if entry is not None:
+            tree = ET.fromstring(entry.data)
+            releases |= {
+                get_int(e) for e in tree.iterfind("./Group/Release/Release/ID")
+            }
+    events: set[int] = set()
+    for id in releases:
+        entry = store.get("release", id)
+        if entry is not None:
+            tree = ET.fromstring(entry.data)
+            events |= {get_int(e) for e in tree.iterfind(".//ReleasedAt/Event/ID")}
+    return {"release": releases, "group": groups, "event": events}
+
+
+def export_precache(
+    path: Path, top_groups: int | None = None, rebuild: bool = False
+) -> int:
+    """
+    Export the metadata in the store to a precache pack. If the pack
+    exists only new and changed entries are added to it, unless `rebuild`
+    is set. Returns number of exported entries.
+    """
+    keep = popular_ids(top_groups) if top_groups is not None else None
+    entries = (
+        (kind, id, entry)
+        for kind, id, entry in store.entries()
+        if entry.data != missing_xml and (keep is None or id in keep[kind])
+    )
+    if rebuild or not path.exists():
+        return write_pack(path, entries)
+
+    pack = Pack(path)
+
+    def changed(kind: str, id: int, entry: Entry) -> bool:
+        fetched = pack.fetched(kind, id)
+        if fetched is None:
+            return True
+        if fetched == int(entry.fetched):
+            return False
+        old = pack.get(kind, id)
+        return old is None or old.data != entry.data
+
+    try:
+        return append_pack(path, (e for e in entries if changed(*e)))
+    finally:
+        pack.close()
+
+
+def run_command(command: list[str], args: argparse.Namespace) -> int:
+    if command == ["cache", "gc"]:
+        cache_size = args.cache_size
+        collect_cache(parse_size(cache_size) if cache_size is not None else None)
+        return 0
+    if command[:2] == ["cache", "export"] and len(command) <= 3:
+        path = Path(command[2]) if len(command) == 3 else precache_file
+        top = int(args.top_groups) if args.top_groups is not None else None
+        new = not path.exists() or args.rebuild
+        count = export_precache(path, top, args.rebuild)
+        print(f"{'Wrote' if new else 'Added'} {count} entries to {path}")
+        return 0
+    if command == ["cache", "import"]:
+        for what in ("release", "group", "event"):
+            path = Path(f".{what}s")
+            if path.is_dir():
+                count = store.import_dir(what, path)
+                print(f"Imported {count} {what}s from {path}/")
+        print("Done. The old directories are no longer needed.")
+        return 0
+    print(f"**Error: Unknown command `{' '.join(command)}`")
+    return 1
+
+
 def main():
     examples = """
 # Download 10 best demos
@@ -351,10 +871,6 @@ def main():
 # Download Gubbdata 2021 releases 
 ./csdb.py -e "Gubbdata 2021" -t "Parties/{event}/{compo}/{{place:02}. }{group} - {title}"
 """
-    if not check_tools():
-        return 1
-    unpack_precache()
-
     arg_parser = argparse.ArgumentParser(
         prog="csdb_tool",
         description="Scrape CSDb.",
@@ -412,6 +928,76 @@ def main():
     arg_parser.add_argument(
         "-r", "--min-rating", help="Minium rating; 0 = filter out unrated."
     )
+    arg_parser.add_argument(
+        "-j", "--jobs", help="Number of concurrent metadata fetches", default=8
+    )
+    arg_parser.add_argument(
+        "--download-jobs", help="Number of concurrent downloads", default=4
+    )
+    arg_parser.add_argument(
+        "--unpack-jobs", help="Number of archives to unpack in parallel", default=2
+    )
+    arg_parser.add_argument(
+        "--rate",
+        nargs="*",
+        default=[],
+        help="Max requests per second; a default (ie 2) and/or per host (ie csdb.dk=4)",
+    )
+    arg_parser.add_argument(
+        "--revalidate",
+        nargs="?",
+        const="0",
+        metavar="AGE",
+        help="Check cached metadata older than AGE (ie 12h or 7d) for updates; "
+        "all of it if no AGE is given",
+    )
+    arg_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Fetch search results and top lists from CSDb even if they are cached",
+    )
+    arg_parser.add_argument(
+        "--retry-failed",
+        default="7d",
+        metavar="AGE",
+        help="Skip downloads (and CSDb ids) that were missing or unusable "
+        "until AGE has passed; 0 to try them all again",
+    )
+    arg_parser.add_argument(
+        "--hedge",
+        nargs="?",
+        const="2",
+        metavar="SECONDS",
+        help="If a download has not started after SECONDS (default 2), "
+        "also try the next mirror in parallel",
+    )
+    arg_parser.add_argument(
+        "--record",
+        metavar="DIR",
+        help="Save all network responses in DIR, to be served by replay.py",
+    )
+    arg_parser.add_argument(
+        "--replay",
+        metavar="URL",
+        help="Send all network requests to a replay.py server at URL",
+    )
+    arg_parser.add_argument(
+        "--cache-size",
+        metavar="SIZE",
+        help="Max size of downloaded archives to keep in releases/ (ie 20G); "
+        "the least recently used ones are removed after each run",
+    )
+    arg_parser.add_argument(
+        "--top-groups",
+        metavar="N",
+        help="With `cache export`, only export the top N groups, their releases, "
+        "releases on the top lists and their events",
+    )
+    arg_parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="With `cache export`, write a new pack instead of adding to it",
+    )
     arg_parser.add_argument("--to-prg", help="Convert D64 to prg", action="store_true")
     arg_parser.add_argument(
         "-t",
@@ -420,7 +1006,22 @@ def main():
         default="Demos/{rank:03}. {group} - {title}{ ({year})}",
     )
 
+    arg_parser.add_argument(
+        "command",
+        nargs="*",
+        help="Maintenance command instead of downloading; "
+        "`cache import` moves old style metadata cache directories into the store, "
+        "`cache gc` cleans up releases/ (down to --cache-size, if given), "
+        "`cache export [FILE]` adds new and changed metadata to a precache pack "
+        "(data/precache.pack)",
+    )
+
     args = arg_parser.parse_args()
+    if args.command:
+        return run_command(args.command, args)
+
+    unpack_precache()
+
     min_rating = -1
 
     v = int(args.verbose)
@@ -468,73 +1069,95 @@ def main():
 
     to_prg: bool = args.to_prg
     max_rel: int = int(args.max_releases)
-
-    links: list[Link] = []
+    jobs: int = max(1, int(args.jobs))
+    download_jobs: int = max(1, int(args.download_jobs))
+    unpack_jobs: int = max(1, int(args.unpack_jobs))
+
+    rates: list[str] = args.rate
+    for spec in rates:
+        host, _, rate = spec.rpartition("=")
+        session.limiter.set_limit(host, float(rate))
+    if args.revalidate is not None:
+        set_revalidate(parse_age(args.revalidate))
+    set_retry_window(parse_age(args.retry_failed))
+    set_refresh_pages(args.refresh)
+    if args.record is not None:
+        session.hooks.append(FixtureStore(Path(args.record)).record)
+    if args.replay is not None:
+        session.proxy = args.replay
+
+    # Where to get links from; lists, or generators that only fetch more
+    # (pages of search results or top lists, groups) when needed
+    sources: list[Iterable[Link]] = []
 
     if args.id is not None:
         ids: list[str] = args.id
+        sources.append([Link(int(id)) for id in ids])
+
+    def event_links(ids: Iterable[int]) -> Iterator[Link]:
         for id in ids:
-            links.append(Link(int(id)))
+            event = get_event(id)
+            log(f"Adding event {event.name}")
+            for compo in event.compos:
+                yield from compo.releases
+
+    def group_links(ids: Iterable[int]) -> Iterator[Link]:
+        for id in ids:
+            yield from get_group_releases(id)
 
     if args.event is not None:
         events: list[str] = args.event
         if len(events) > 0:
             if len(events) == 1 and not events[0].isdigit():
-                pids = search("events", events[0])
-                log(f"Adding {len(pids)} events")
-                for pid in pids:
-                    event = get_event(pid)
-                    for compo in event.compos:
-                        links += compo.releases
+                sources.append(event_links(find_ids("event", events[0])))
             else:
                 for event in events:
                     if not event.isdigit():
                         print("*NOTE* Multiple events needs to all be integers (ids)")
                         sys.exit(0)
-                    event = get_event(int(event))
-                    for compo in event.compos:
-                        links += compo.releases
+                sources.append(event_links(int(event) for event in events))
 
     if args.groups is not None:
         groups: list[str] = args.groups
         if len(groups) == 1 and not groups[0].isdigit():
             if groups[0] == "TOP":
                 print("Getting all groups")
-                all = get_groups()
-                all = all[:500]
-                for _, id in all:
-                    links += get_group_releases(id)
+                top = itertools.islice(toplist_links("group"), 500)
+                sources.append(group_links(link.id for link in top))
             else:
-                pids = search("groups", groups[0])
-                for id in pids:
-                    links += get_group_releases(id)
+                sources.append(group_links(find_ids("group", groups[0])))
         else:
-            for group in groups:
-                id = int(group)
-                links += get_group_releases(id)
+            sources.append(group_links(int(group) for group in groups))
 
     if args.top_list is not None:
         what: str = args.top_list
-        links = get_toplist_releases(what)
+        sources = [toplist_links(what)]
 
-    print(f"Collected {len(links)} releases")
+    cached = store.ids("release")
+    pack = get_precache()
+    if pack is not None:
+        cached |= pack.ids("release")
+    legacy = legacy_dir("release")
 
-    count = 0
-    for link in links:
-        f = Path(".releases") / f"{link.id}.xml"
-        if not f.exists():
-            count += 1
-    print(f"Need to fetch {count} metadata")
-
-    releases: list[Release] = []
-    for link in links:
-        rel = populate_release(link)
-        if rel is None:
-            continue
+    def uncached(link: Link) -> bool:
+        return link.id not in cached and f"{link.id}.xml" not in legacy
+
+    if all(isinstance(source, list) for source in sources):
+        # Nothing more to fetch to know them all
+        count = sum(uncached(link) for source in sources for link in source)
+        print(f"Need to fetch {count} metadata")
+
+    links = itertools.chain.from_iterable(sources)
+    checked = fetched = 0
+
+    def accept(link: Link, rel: Release) -> bool:
+        nonlocal checked, fetched
+        checked += 1
+        fetched += uncached(link)
         if args.groups is not None:
             rel.group = link.name
         if rel.year < min_year or rel.year > max_year:
-            continue
+            return False
         ok = False
         if rel_types is not None:
             for rt in rel_types:
@@ -543,23 +1166,22 @@ def main():
                     break
         ok |= filter(rel)
         if not ok:
-            continue
-        if rel.rating < min_rating:
-            continue
-        releases.append(rel)
-        if len(releases) >= max_rel:
-            break
-
-    found = 0
-    for rel in releases:
-        for url in rel.downloads:
-            t = urllib.parse.unquote_plus(url)
-            name = urllib.parse.quote_plus(t)
-            if Path(f"releases/{name}").exists():
-                found += 1
-                break
-    print(f"Need to download {len(releases)-found} releases")
-    download_releases(releases, template, to_prg)
+            return False
+        return rel.rating >= min_rating
+
+    hedge = float(args.hedge) if args.hedge is not None else None
+    releases = iter_releases(links, accept, max_rel, jobs)
+    unpacked = download_releases(
+        releases, template, to_prg, hedge, download_jobs, unpack_jobs
+    )
+    print(f"Checked {checked} releases, fetched metadata for {fetched}")
+    print(f"Unpacked {unpacked} releases")
+    if args.cache_size is not None:
+        collect_cache(parse_size(args.cache_size))
+    if revalidate_age is not None:
+        checked, changed = revalidated["checked"], revalidated["changed"]
+        print(f"Revalidated {checked} cached metadata entries, {changed} changed")
+    print(session.summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+# D64 disk images hold the 256 byte sectors of a 1541 disk, track by track.
+# Tracks are numbered from 1 and sectors from 0. Some images have 40 tracks
+# instead of 35, and some end with one error code byte per sector.
+#
+# Track 18 is the directory track; sector 0 is the BAM (block availability
+# map, disk name and id) and the directory is a chain of sectors starting
+# at sector 1. Each sector of a chain starts with the track and sector of
+# the next one. In the last sector, the track is 0 and the sector byte is
+# instead the position of the last byte used.
+
+sector_size = 256
+dir_track = 18
+
+# Sectors per track, for tracks 1-40
+track_sectors = [21] * 17 + [19] * 7 + [18] * 6 + [17] * 10
+
+# Offset in the image of each track, with a dummy track 0
+track_offsets = [0, 0]
+for sectors in track_sectors:
+    track_offsets.append(track_offsets[-1] + sectors * sector_size)
+
+# Image size -> (tracks, has error bytes)
+image_sizes: dict[int, tuple[int, bool]] = {}
+for tracks in (35, 40):
+    sectors = sum(track_sectors[:tracks])
+    image_sizes[sectors * sector_size] = (tracks, False)
+    image_sizes[sectors * (sector_size + 1)] = (tracks, True)
+
+file_types = ["DEL", "SEQ", "PRG", "USR", "REL"]
+
+
+@dataclass
+class DirEntry:
+    name: bytes
+    type: str
+    track: int
+    sector: int
+    blocks: int
+
+
+def petscii_name(name: bytes) -> str:
+    """
+    PETSCII file name to a name for the host; letters in lower case, as
+    they are shown by default on the C64, and anything unprintable as "_"
+    """
+    chars: list[str] = []
+    for c in name:
+        if 0x41 <= c <= 0x5A:
+            chars.append(chr(c + 0x20))
+        elif 0xC1 <= c <= 0xDA:
+            chars.append(chr(c - 0x80))
+        elif 0x61 <= c <= 0x7A:
+            chars.append(chr(c - 0x20))
+        elif 0x20 <= c <= 0x40 and c != 0x2F or c in (0x5B, 0x5D):
+            chars.append(chr(c))
+        else:
+            chars.append("_")
+    return "".join(chars)
+
+
+class D64:
+    """
+    Read only view of a D64 disk image in `data`. Sectors are read as
+    slices of a `memoryview`, so nothing is copied until a file is read.
+    """
+
+    def __init__(self, data: bytes | bytearray):
+        if len(data) not in image_sizes:
+            raise ValueError(f"Not a D64 image ({len(data)} bytes)")
+        self.tracks, has_errors = image_sizes[len(data)]
+        self.data = memoryview(data)
+        self.errors = (
+            self.data[track_offsets[self.tracks + 1] :] if has_errors else None
+        )
+
+    def index(self, track: int, sector: int) -> int:
+        """Number of a sector, counting from the start of the disk"""
+        if track < 1 or track > self.tracks or sector >= track_sectors[track - 1]:
+            raise ValueError(f"Illegal track/sector {track}/{sector}")
+        return track_offsets[track] // sector_size + sector
+
+    def sector(self, track: int, sector: int) -> memoryview:
+        offset = self.index(track, sector) * sector_size
+        return self.data[offset : offset + sector_size]
+
+    def error(self, track: int, sector: int) -> int:
+        """Error code of a sector, as read from the disk. 1 means no error"""
+        if self.errors is None:
+            return 1
+        return self.errors[self.index(track, sector)]
+
+    def sectors(self, track: int, sector: int) -> Iterator[memoryview]:
+        """The sectors of a chain, starting at `track`/`sector`"""
+        seen: set[int] = set()
+        while track != 0:
+            index = self.index(track, sector)
+            if index in seen:
+                raise ValueError(f"Loop in sector chain at {track}/{sector}")
+            seen.add(index)
+            data = self.sector(track, sector)
+            yield data
+            track, sector = data[0], data[1]
+
+    def chain(self, track: int, sector: int) -> Iterator[memoryview]:
+        """The used part of each sector in a chain"""
+        for data in self.sectors(track, sector):
+            yield data[2:] if data[0] != 0 else data[2 : max(data[1] + 1, 2)]
+
+    @property
+    def name(self) -> bytes:
+        bam = self.sector(dir_track, 0)
+        return bytes(bam[0x90:0xA0]).rstrip(b"\xa0")
+
+    def directory(self) -> Iterator[DirEntry]:
+        """All files on the disk (including DEL files)"""
+        for data in self.sectors(dir_track, 1):
+            for offset in range(0, sector_size, 32):
+                entry = data[offset : offset + 32]
+                code = entry[2] & 0x0F
+                if entry[2] == 0 or code >= len(file_types):
+                    continue
+                yield DirEntry(
+                    bytes(entry[5:21]).rstrip(b"\xa0"),
+                    file_types[code],
+                    entry[3],
+                    entry[4],
+                    entry[30] | entry[31] << 8,
+                )
+
+    def read(self, entry: DirEntry) -> bytes:
+        return b"".join(self.chain(entry.track, entry.sector))
+
+
+def extract(
+    image: Path, targetdir: Path, types: tuple[str, ...] = ("PRG", "SEQ")
+) -> int:
+    """
+    Write the files of `types` in a D64 image to `targetdir`, named like
+    `name.prg`. Files with broken sector chains are skipped. Returns the
+    number of files written.
+    """
+    count = 0
+    d64 = D64(image.read_bytes())
+    for entry in d64.directory():
+        if entry.type not in types:
+            continue
+        name = petscii_name(entry.name)
+        ext = entry.type.lower()
+        target = targetdir / f"{name}.{ext}"
+        n = 1
+        while target.exists():
+            n += 1
+            target = targetdir / f"{name}_{n}.{ext}"
+        try:
+            data = d64.read(entry)
+        except ValueError:
+            continue
+        target.write_bytes(data)
+        count += 1
+    return count
+
+
+# Order tracks are filled in by `D64Writer`, closest to the directory first
+fill_order = list(range(dir_track - 1, 0, -1)) + list(range(dir_track + 1, 36))
+file_interleave = 10
+dir_interleave = 3
+
+
+def petscii(name: str) -> bytes:
+    """Host file name to PETSCII; the reverse of `petscii_name()`"""
+    chars = bytearray()
+    for c in map(ord, name):
+        if 0x61 <= c <= 0x7A:
+            chars.append(c - 0x20)
+        elif 0x41 <= c <= 0x5A:
+            chars.append(c + 0x80)
+        elif 0x20 <= c <= 0x40 or c in (0x5B, 0x5D):
+            chars.append(c)
+        else:
+            chars.append(0x2D)
+    return bytes(chars)
+
+
+class D64Writer:
+    """
+    Builds a 35 track D64 image in memory. Sectors are allocated like
+    1541 DOS does it; files from the tracks next to the directory and
+    outwards, `file_interleave` sectors apart, and directory sectors
+    `dir_interleave` apart on track 18.
+    """
+
+    def __init__(self, name: bytes, id: bytes = b"00"):
+        self.image = bytearray(track_offsets[36])
+        self.data = memoryview(self.image)
+        self.used: list[set[int]] = [set() for _ in range(36)]
+        self.used[dir_track] |= {0, 1}
+        self.dir_sector = 1
+        self.sector(dir_track, 1)[1] = 0xFF
+        self.entries = 0
+
+        bam = self.sector(dir_track, 0)
+        bam[0:4] = bytes([dir_track, 1, 0x41, 0])
+        bam[0x90:0xAB] = b"\xa0" * 0x1B
+        bam[0x90 : 0x90 + len(name[:16])] = name[:16]
+        bam[0xA2:0xA4] = id[:2].ljust(2, b"0")
+        bam[0xA5:0xA7] = b"2A"
+
+    def sector(self, track: int, sector: int) -> memoryview:
+        offset = (track_offsets[track] // sector_size + sector) * sector_size
+        return self.data[offset : offset + sector_size]
+
+    def allocate(self, track: int, sector: int, interleave: int) -> tuple[int, int]:
+        """
+        Allocate the next sector of a chain after `track`/`sector` (0/0 to
+        start a new one); `interleave` sectors further on the same track if
+        possible, otherwise the first free one on the next track.
+        """
+        if track > 0:
+            count = track_sectors[track - 1]
+            for i in range(count):
+                s = (sector + interleave + i) % count
+                if s not in self.used[track]:
+                    self.used[track].add(s)
+                    return track, s
+            if track == dir_track:
+                raise ValueError("Directory full")
+        tracks = fill_order[fill_order.index(track) :] if track > 0 else fill_order
+        for t in tracks:
+            free = set(range(track_sectors[t - 1])) - self.used[t]
+            if free:
+                s = min(free)
+                self.used[t].add(s)
+                return t, s
+        raise ValueError("Disk full")
+
+    def add(self, name: bytes, data: bytes, type: str = "PRG"):
+        """Add a file called `name` (in PETSCII)"""
+        chunks = [data[i : i + 254] for i in range(0, len(data), 254)] or [b""]
+        first = track, sector = self.allocate(0, 0, file_interleave)
+        for i, chunk in enumerate(chunks):
+            current = self.sector(track, sector)
+            if i + 1 < len(chunks):
+                track, sector = self.allocate(track, sector, file_interleave)
+                current[0:2] = bytes([track, sector])
+            else:
+                current[0:2] = bytes([0, len(chunk) + 1])
+            current[2 : 2 + len(chunk)] = chunk
+
+        dir = self.sector(dir_track, self.dir_sector)
+        if self.entries > 0 and self.entries % 8 == 0:
+            _, sector = self.allocate(dir_track, self.dir_sector, dir_interleave)
+            dir[0:2] = bytes([dir_track, sector])
+            self.dir_sector = sector
+            dir = self.sector(dir_track, sector)
+            dir[1] = 0xFF
+        offset = (self.entries % 8) * 32
+        entry = dir[offset : offset + 32]
+        entry[2:5] = bytes([0x80 | file_types.index(type), *first])
+        entry[5:21] = name[:16].ljust(16, b"\xa0")
+        entry[30:32] = len(chunks).to_bytes(2, "little")
+        self.entries += 1
+
+    def finish(self) -> bytearray:
+        """The image, with the BAM updated to what has been added"""
+        bam = self.sector(dir_track, 0)
+        for track in range(1, 36):
+            free = 0
+            bits = 0
+            for s in range(track_sectors[track - 1]):
+                if s not in self.used[track]:
+                    free += 1
+                    bits |= 1 << s
+            bam[track * 4 : track * 4 + 4] = bytes([free]) + bits.to_bytes(3, "little")
+        return self.image
@@ -0,0 +1,399 @@
+#!/usr/bin/python
+
+import http.client
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from dataclasses import dataclass, field
+from email.message import Message
+from typing import Any, Callable
+
+# Keep the same User-Agent as plain `urlopen()`
+user_agent = f"Python-urllib/{urllib.request.__version__}"
+
+redirects = {301, 302, 303, 307, 308}
+
+# Responses that mean the server wants us to slow down
+throttled = {429, 500, 502, 503, 504}
+
+# Errors that mean a pooled connection was closed by the server while idle
+stale_errors = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+@dataclass
+class Stats:
+    requests: int = 0
+    opened: int = 0
+    reused: int = 0
+    unpooled: int = 0
+
+
+@dataclass
+class Bucket:
+    """Token bucket state for one host"""
+
+    max_rate: float
+    rate: float
+    tokens: float = 1
+    stamp: float = field(default_factory=time.monotonic)
+    blocked_until: float = 0
+    failures: int = 0
+    requests: int = 0
+    throttled: int = 0
+    waited: float = 0
+
+
+class RateLimiter:
+    """
+    Per-host token bucket rate limiter.
+
+    The allowed rate for a host is adapted with AIMD; it is halved for every
+    throttled or timed out request (which also blocks the host for an
+    exponentially growing, jittered backoff time) and then increases slowly
+    back to the configured max rate as requests succeed.
+    """
+
+    def __init__(self, rate: float = 4, backoff: float = 1, max_backoff: float = 120):
+        self.default_rate = rate
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limits: dict[str, float] = {}
+        self.buckets: dict[str, Bucket] = {}
+        self.lock = threading.Lock()
+
+    def set_limit(self, host: str, rate: float):
+        """Set max requests per second for `host`, or the default if `host` is empty"""
+        with self.lock:
+            if host == "":
+                self.default_rate = rate
+            else:
+                self.limits[host] = rate
+            self.buckets.clear()
+
+    def _bucket(self, host: str) -> Bucket:
+        b = self.buckets.get(host)
+        if b is None:
+            rate = self.limits.get(host, self.default_rate)
+            b = Bucket(rate, rate, tokens=max(1, rate))
+            self.buckets[host] = b
+        return b
+
+    def acquire(self, host: str):
+        """Block until a request to `host` is allowed"""
+        while True:
+            with self.lock:
+                b = self._bucket(host)
+                now = time.monotonic()
+                b.tokens = min(max(1, b.rate), b.tokens + (now - b.stamp) * b.rate)
+                b.stamp = now
+                wait = b.blocked_until - now
+                if wait <= 0:
+                    if b.tokens >= 1:
+                        b.tokens -= 1
+                        b.requests += 1
+                        return
+                    wait = (1 - b.tokens) / b.rate
+                b.waited += wait
+            time.sleep(wait)
+
+    def success(self, host: str):
+        with self.lock:
+            b = self._bucket(host)
+            b.failures = 0
+            b.rate = min(b.max_rate, b.rate + b.max_rate / 10)
+
+    def failure(self, host: str, retry_after: float | None = None) -> float:
+        """Register a throttled request; returns the backoff time in seconds"""
+        with self.lock:
+            b = self._bucket(host)
+            b.failures += 1
+            b.throttled += 1
+            b.rate = max(b.max_rate / 32, b.rate / 2)
+            delay = min(self.max_backoff, self.backoff * 2 ** (b.failures - 1))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.max_backoff))
+            b.blocked_until = time.monotonic() + delay
+            return delay
+
+    def summary(self) -> list[str]:
+        with self.lock:
+            items = sorted(self.buckets.items(), key=lambda i: -i[1].requests)
+            return [
+                f"  {host}: {b.requests} requests, {b.rate:.1f}/{b.max_rate:.1f} req/s,"
+                f" {b.throttled} throttled, {b.waited:.1f}s waited"
+                for host, b in items
+            ]
+
+
+def retry_after(headers: Message) -> float | None:
+    value = headers.get("Retry-After")
+    if value is not None and value.strip().isdigit():
+        return float(value)
+    return None
+
+
+def is_timeout(e: urllib.error.URLError) -> bool:
+    return isinstance(e.reason, TimeoutError)
+
+
+class ConnectTimeout(TimeoutError):
+    """Timed out while connecting; the host is probably down"""
+
+
+class Response:
+    """
+    An open response from a `Session`. Read it to the end or close it;
+    the underlying connection then goes back to the pool if it can be reused.
+    """
+
+    def __init__(self, url: str, status: int, reason: str, headers: Message, fp: Any):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.fp = fp
+        self.on_close: list[Any] = []
+
+    def read(self, amt: int | None = None) -> bytes:
+        try:
+            data: bytes = self.fp.read(amt)
+        except (OSError, http.client.HTTPException) as e:
+            # Timed out or cut off in the middle of the body
+            self.close()
+            if isinstance(e, urllib.error.URLError):
+                raise
+            raise urllib.error.URLError(e)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def close(self):
+        if getattr(self.fp, "length", None) == 0:
+            # No body left (ie 304), so the connection can still be reused
+            try:
+                self.fp.read()
+            except (OSError, http.client.HTTPException):
+                pass
+        callbacks, self.on_close = self.on_close, []
+        for cb in callbacks:
+            cb()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_: Any):
+        self.close()
+
+
+class Session:
+    """
+    Keep-alive HTTP(S) client with a per-host connection pool.
+    Non HTTP URLs (ie ftp://) fall back to `urllib.request.urlopen()`.
+    Errors are raised as `urllib.error.HTTPError` and `urllib.error.URLError`,
+    just like `urlopen()`, also when reading the body of a response.
+
+    All requests go through `limiter`, and throttled (429/5xx) or timed out
+    requests are retried up to `retries` times. Connecting gives up after
+    `connect_timeout` seconds, and is only retried `connect_retries` times,
+    so a dead host doesn't hold things up for long.
+
+    If `proxy` is set (ie "http://localhost:8064") all requests are sent
+    there instead, with the original URL as the request target.
+    Every response returned from `open()` is passed to the `hooks`, along
+    with the URL that was asked for.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 60,
+        max_idle: int = 16,
+        retries: int = 4,
+        connect_timeout: float = 10,
+        connect_retries: int = 1,
+    ):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+        self.connect_retries = connect_retries
+        self.limiter = RateLimiter()
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.idle: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+        self.proxy: str | None = None
+        self.hooks: list[Callable[[str, Response], None]] = []
+
+    def _connect(
+        self, scheme: str, netloc: str
+    ) -> tuple[http.client.HTTPConnection, bool]:
+        with self.lock:
+            self.stats.requests += 1
+            conns = self.idle.get((scheme, netloc))
+            if conns:
+                self.stats.reused += 1
+                return conns.pop(), True
+            self.stats.opened += 1
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.connect_timeout)
+        try:
+            conn.connect()
+        except TimeoutError:
+            conn.close()
+            raise urllib.error.URLError(ConnectTimeout(f"Can not connect to {netloc}"))
+        except OSError as e:
+            conn.close()
+            raise urllib.error.URLError(e)
+        conn.sock.settimeout(self.timeout)
+        return conn, False
+
+    def _release(
+        self,
+        scheme: str,
+        netloc: str,
+        conn: http.client.HTTPConnection,
+        resp: http.client.HTTPResponse,
+    ):
+        if not resp.isclosed() or conn.sock is None:
+            # Not fully read, or server wants to close; can not be reused
+            conn.close()
+            return
+        with self.lock:
+            conns = self.idle.setdefault((scheme, netloc), [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _request(self, url: str, headers: dict[str, str]) -> Response:
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        if self.proxy is not None:
+            parts = urllib.parse.urlsplit(self.proxy)
+            path = url
+        hdrs = {"User-Agent": user_agent, "Accept-Encoding": "identity"}
+        hdrs.update(headers)
+        while True:
+            conn, reused = self._connect(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers=hdrs)
+                resp = conn.getresponse()
+                break
+            except stale_errors as e:
+                conn.close()
+                if not reused:
+                    raise urllib.error.URLError(e)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise urllib.error.URLError(e)
+        response = Response(url, resp.status, resp.reason, resp.headers, resp)
+        response.on_close.append(
+            lambda: self._release(parts.scheme, parts.netloc, conn, resp)
+        )
+        return response
+
+    def _urlopen(self, url: str, headers: dict[str, str]) -> Response:
+        with self.lock:
+            self.stats.requests += 1
+            self.stats.unpooled += 1
+        req = urllib.request.Request(url, headers=headers)
+        try:
+            r = urllib.request.urlopen(req, timeout=self.timeout)
+        except TimeoutError as e:
+            raise urllib.error.URLError(e)
+        status = getattr(r, "status", None) or 200
+        return Response(url, status, getattr(r, "reason", ""), r.headers, r)
+
+    def _send(self, url: str, headers: dict[str, str]) -> Response:
+        """Do one request through the rate limiter, retrying if throttled"""
+        parts = urllib.parse.urlsplit(url)
+        host = parts.hostname or ""
+        attempt = 0
+        while True:
+            self.limiter.acquire(host)
+            attempt += 1
+            try:
+                if parts.scheme in ("http", "https") or self.proxy is not None:
+                    resp = self._request(url, headers)
+                else:
+                    resp = self._urlopen(url, headers)
+            except urllib.error.HTTPError as e:
+                if e.code not in throttled:
+                    raise
+                self.limiter.failure(host, retry_after(e.headers))
+                if attempt > self.retries:
+                    raise
+                continue
+            except urllib.error.URLError as e:
+                if not is_timeout(e):
+                    raise
+                self.limiter.failure(host)
+                if isinstance(e.reason, ConnectTimeout):
+                    if attempt > self.connect_retries:
+                        raise
+                elif attempt > self.retries:
+                    raise
+                continue
+            if resp.status in throttled:
+                self.limiter.failure(host, retry_after(resp.headers))
+                if attempt <= self.retries:
+                    resp.read()
+                    continue
+            else:
+                self.limiter.success(host)
+            return resp
+
+    def open(self, url: str, headers: dict[str, str] | None = None) -> Response:
+        """Start a GET request for `url`, following redirects"""
+        headers = headers or {}
+        asked = url
+        for _ in range(10):
+            scheme = urllib.parse.urlsplit(url).scheme
+            if scheme == "":
+                raise ValueError(f"unknown url type: {url!r}")
+            resp = self._send(url, headers)
+            location = resp.headers.get("Location")
+            if resp.status in redirects and location is not None:
+                resp.read()
+                url = urllib.parse.urljoin(url, location.replace(" ", "%20"))
+                continue
+            for hook in self.hooks:
+                hook(asked, resp)
+            if resp.status >= 400:
+                resp.read()
+                raise urllib.error.HTTPError(
+                    url, resp.status, resp.reason, resp.headers, None
+                )
+            return resp
+        raise urllib.error.URLError(f"Too many redirects for {url}")
+
+    def fetch(self, url: str, headers: dict[str, str] | None = None) -> bytes:
+        """GET `url` and return the whole body"""
+        with self.open(url, headers) as resp:
+            return resp.read()
+
+    def summary(self) -> str:
+        s = self.stats
+        pooled = s.opened + s.reused
+        pct = s.reused * 100 // pooled if pooled > 0 else 0
+        lines = [
+            f"HTTP: {s.requests} requests, {s.opened} connections opened, "
+            f"{s.reused} reused ({pct}%)"
+        ]
+        return "\n".join(lines + self.limiter.summary())
+
+
+session = Session()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+import hashlib
+import mmap
+import struct
+import zlib
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import BinaryIO
+
+from store import Entry
+
+# Precache pack format; all integers little endian.
+#
+#     magic       b"CSDBPAK1"
+#     entries     zlib compressed webservice XML, back to back
+#     index       `count` records of (kind, id, offset, length, fetched),
+#                 sorted on (kind, id)
+#     trailer     index offset, count, b"CSDBIDX1"
+#
+# The index sits at the end so new entries can be appended after the old
+# ones, followed by a new index (see `append_pack()`). Entries with the
+# same data share the same bytes.
+
+magic = b"CSDBPAK1"
+index_magic = b"CSDBIDX1"
+record = struct.Struct("<BIQII")
+trailer = struct.Struct("<QI8s")
+
+kinds = ["release", "group", "event"]
+kind_codes = {kind: code for code, kind in enumerate(kinds)}
+
+
+class Pack:
+    """
+    Read only, random access view of a precache pack. The file is mapped
+    into memory and entries are found with a binary search of the index,
+    so opening it is instant regardless of its size.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[: len(magic)] != magic or len(self.mm) < trailer.size:
+            raise ValueError(f"{path} is not a precache pack")
+        self.index, self.count, tag = trailer.unpack_from(
+            self.mm, len(self.mm) - trailer.size
+        )
+        if tag != index_magic:
+            raise ValueError(f"{path} has no index")
+
+    def _record(self, i: int) -> tuple[int, int, int, int, int]:
+        return record.unpack_from(self.mm, self.index + i * record.size)
+
+    def _find(self, key: tuple[int, int]) -> int:
+        """Index of first record >= `key`"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[:2] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _lookup(self, kind: str, id: int) -> tuple[int, int, int, int, int] | None:
+        key = (kind_codes[kind], id)
+        i = self._find(key)
+        if i == self.count:
+            return None
+        rec = self._record(i)
+        return rec if rec[:2] == key else None
+
+    def get(self, kind: str, id: int) -> Entry | None:
+        rec = self._lookup(kind, id)
+        if rec is None:
+            return None
+        _, _, offset, length, fetched = rec
+        data = zlib.decompress(self.mm[offset : offset + length])
+        return Entry(data, float(fetched))
+
+    def fetched(self, kind: str, id: int) -> int | None:
+        """Fetch time of an entry, without reading it"""
+        rec = self._lookup(kind, id)
+        return rec[4] if rec is not None else None
+
+    def ids(self, kind: str) -> set[int]:
+        code = kind_codes[kind]
+        ids: set[int] = set()
+        for i in range(self._find((code, 0)), self.count):
+            c, id, *_ = self._record(i)
+            if c != code:
+                break
+            ids.add(id)
+        return ids
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[tuple[str, int, Entry]]:
+        for i in range(self.count):
+            code, id, offset, length, fetched = self._record(i)
+            data = zlib.decompress(self.mm[offset : offset + length])
+            yield kinds[code], id, Entry(data, float(fetched))
+
+    def close(self):
+        self.mm.close()
+
+
+def _write_entries(
+    f: BinaryIO,
+    entries: Iterable[tuple[str, int, Entry]],
+    index: dict[tuple[int, int], tuple[int, int, int]],
+) -> int:
+    """
+    Write `entries` at the current position of `f`, adding them to `index`.
+    Entries with the same data are only written once. Returns number of
+    entries written.
+    """
+    written: dict[bytes, tuple[int, int]] = {}
+    count = 0
+    for kind, id, entry in entries:
+        digest = hashlib.sha1(entry.data).digest()
+        if digest not in written:
+            data = zlib.compress(entry.data, 9)
+            written[digest] = (f.tell(), len(data))
+            f.write(data)
+        offset, length = written[digest]
+        index[(kind_codes[kind], id)] = (offset, length, int(entry.fetched))
+        count += 1
+    return count
+
+
+def _write_index(f: BinaryIO, index: dict[tuple[int, int], tuple[int, int, int]]):
+    index_offset = f.tell()
+    for (code, id), (offset, length, fetched) in sorted(index.items()):
+        f.write(record.pack(code, id, offset, length, fetched))
+    f.write(trailer.pack(index_offset, len(index), index_magic))
+
+
+def write_pack(path: Path, entries: Iterable[tuple[str, int, Entry]]) -> int:
+    """Write a new precache pack with `entries`. Returns number of entries"""
+    index: dict[tuple[int, int], tuple[int, int, int]] = {}
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(magic)
+        _write_entries(f, entries, index)
+        _write_index(f, index)
+    tmp.replace(path)
+    return len(index)
+
+
+def append_pack(path: Path, entries: Iterable[tuple[str, int, Entry]]) -> int:
+    """
+    Add `entries` to an existing pack, replacing entries with the same kind
+    and id. The new entries and a new index are written after the end of
+    the file; nothing already in it is changed, so readers that have the
+    pack open can go on using it. Returns number of entries added.
+    """
+    pack = Pack(path)
+    index = {
+        (code, id): (offset, length, fetched)
+        for code, id, offset, length, fetched in map(pack._record, range(len(pack)))
+    }
+    pack.close()
+    with open(path, "ab") as f:
+        count = _write_entries(f, entries, index)
+        if count > 0:
+            _write_index(f, index)
+    return count
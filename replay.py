@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from net import Response
+from utils import parse_size
+
+# Headers that describe the connection rather than the content
+skip_headers = {"connection", "keep-alive", "transfer-encoding", "content-length"}
+
+
+class Tee:
+    """Wraps a response body, saving everything read from it to `target`"""
+
+    def __init__(self, fp: Any, target: Path, meta: dict[str, Any]):
+        self.fp = fp
+        self.target = target
+        self.meta = meta
+        self.tmp = target.with_name(f".{target.name}.{threading.get_ident()}")
+        self.out: BinaryIO | None = open(self.tmp, "wb")
+
+    def read(self, amt: int | None = None) -> bytes:
+        data: bytes = self.fp.read(amt)
+        if self.out is not None:
+            self.out.write(data)
+            if amt is None or not data:
+                self.out.close()
+                self.out = None
+                os.replace(self.tmp, self.target.with_suffix(".body"))
+                json_file = self.target.with_suffix(".json")
+                json_file.write_text(json.dumps(self.meta, indent=1))
+        return data
+
+    def close(self):
+        if self.out is not None:
+            # Not read to the end; don't keep a partial recording
+            self.out.close()
+            self.out = None
+            self.tmp.unlink()
+        self.fp.close()
+
+
+class FixtureStore:
+    """
+    Recorded responses, keyed by URL. Each response is stored as
+    `<hash>.json` (url, status and headers) and `<hash>.body`.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, url: str) -> Path:
+        return self.path / hashlib.sha1(url.encode()).hexdigest()
+
+    def record(self, url: str, resp: Response):
+        """`Session` hook; saves the response once it has been read"""
+        if resp.status in (206, 304):
+            return
+        headers = [
+            (k, v) for k, v in resp.headers.items() if k.lower() not in skip_headers
+        ]
+        meta = {"url": url, "status": resp.status, "headers": headers}
+        resp.fp = Tee(resp.fp, self._file(url), meta)
+
+    def get(self, url: str) -> tuple[dict[str, Any], bytes] | None:
+        f = self._file(url)
+        try:
+            meta: dict[str, Any] = json.loads(f.with_suffix(".json").read_text())
+            return meta, f.with_suffix(".body").read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def urls(self) -> list[str]:
+        return [json.loads(f.read_text())["url"] for f in self.path.glob("*.json")]
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Serves the responses of a `FixtureStore` over HTTP.
+
+    Requests can either use the original URL as target (as when
+    `Session.proxy` points here) or just a path, which is then looked up
+    relative to `origin`.
+
+    `latency` (seconds) is added to every request, `bandwidth` (bytes per
+    second) limits how fast bodies are sent, and `errors` is the fraction
+    of requests that fail with a 503 or a dropped connection.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        store: FixtureStore,
+        address: tuple[str, int] = ("127.0.0.1", 8064),
+        latency: float = 0,
+        bandwidth: int = 0,
+        errors: float = 0,
+        origin: str = "https://csdb.dk",
+    ):
+        super().__init__(address, ReplayHandler)
+        self.store = store
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errors = errors
+        self.origin = origin
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: ReplayServer
+
+    def do_GET(self):
+        srv = self.server
+        url = self.path
+        if url.startswith("/"):
+            url = srv.origin + url
+        time.sleep(srv.latency)
+        if random.random() < srv.errors:
+            if random.random() < 0.5:
+                self.close_connection = True
+                return
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        fixture = srv.store.get(url)
+        if fixture is None:
+            self.send_error(404)
+            return
+        meta, body = fixture
+        headers: list[tuple[str, str]] = [tuple(h) for h in meta["headers"]]
+        etag = next((v for k, v in headers if k.lower() == "etag"), None)
+        if etag is None:
+            etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+            headers.append(("ETag", etag))
+        status: int = meta["status"]
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        rng = self.headers.get("Range", "")
+        start = int(rng[6:-1]) if rng.startswith("bytes=") and rng.endswith("-") else 0
+        if status == 200 and 0 < start < len(body):
+            self.send_response(206)
+            end = len(body) - 1
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            body = body[start:]
+        else:
+            self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.send_body(body)
+
+    def send_body(self, body: bytes):
+        bandwidth = self.server.bandwidth
+        if bandwidth <= 0:
+            self.wfile.write(body)
+            return
+        chunk = max(1024, bandwidth // 20)
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i : i + chunk])
+            time.sleep(min(chunk, len(body) - i) / bandwidth)
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        prog="replay",
+        description="Serve recorded CSDb responses (see csdb.py --record)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    arg_parser.add_argument("fixtures", help="Directory with recorded responses")
+    arg_parser.add_argument("-p", "--port", default=8064, help="Port to listen on")
+    arg_parser.add_argument("--host", default="127.0.0.1", help="Address to bind")
+    arg_parser.add_argument(
+        "--latency", default=0, help="Seconds of latency to add to each request"
+    )
+    arg_parser.add_argument(
+        "--bandwidth", default="0", help="Max bytes per second per request (ie 100k)"
+    )
+    arg_parser.add_argument(
+        "--errors", default=0, help="Fraction of requests that should fail"
+    )
+    arg_parser.add_argument(
+        "--origin",
+        default="https://csdb.dk",
+        help="Site to serve requests without a full URL for",
+    )
+    args = arg_parser.parse_args()
+
+    store = FixtureStore(Path(args.fixtures))
+    server = ReplayServer(
+        store,
+        (args.host, int(args.port)),
+        latency=float(args.latency),
+        bandwidth=parse_size(args.bandwidth),
+        errors=float(args.errors),
+        origin=args.origin,
+    )
+    print(f"Serving {len(store.urls())} responses on {server.url}")
+    print(f"Use `./csdb.py --replay {server.url} ...`")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+import re
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+
+# Elements that never have an end tag
+void_tags = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "param",
+    "source",
+    "track",
+    "wbr",
+}
+
+
+class Done(Exception):
+    """Raised from a handler when the parser has found what it wants"""
+
+
+# Text of links to the rest of a list of results
+next_text = re.compile(r"\s*(show all|next)\b", re.IGNORECASE)
+
+
+class PageParser(HTMLParser):
+    """
+    Base for scrapers that pick things out of CSDb pages as they are
+    parsed, instead of building a tree of the whole page. Keeps a stack of
+    open tags that is closed the way BeautifulSoup does it; an end tag
+    closes everything opened after its start tag, and end tags that match
+    nothing are ignored.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.open: list[str] = []
+        # Link to the next page, see `find_next()`
+        self.next: str | None = None
+        self.after: int | None = None
+        self.link: tuple[str, list[str]] | None = None
+
+    def parse(self, html: str):
+        try:
+            self.feed(html)
+            self.close()
+        except Done:
+            pass
+
+    def find_next(self):
+        """
+        Called when a list of results ends. The rest of the page is only
+        searched for a link to the next page, up to the end of the element
+        the list was in.
+        """
+        self.after = len(self.open)
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        if self.after is not None:
+            if tag in ("hr", "table", "ol"):
+                raise Done
+            if tag == "a" and self.link is None:
+                self.link = (dict(attrs).get("href") or "", [])
+        else:
+            self.start(tag, dict(attrs))
+        if tag not in void_tags:
+            self.open.append(tag)
+
+    def handle_endtag(self, tag: str):
+        if tag not in self.open:
+            return
+        if self.after is not None:
+            if self.open[::-1].index(tag) >= len(self.open) - self.after:
+                raise Done
+            if tag == "a" and self.link is not None:
+                href, text = self.link
+                if next_text.match("".join(text)):
+                    self.next = href
+                raise Done
+        while True:
+            t = self.open.pop()
+            if self.after is None:
+                self.end(t)
+            if t == tag:
+                return
+
+    def handle_data(self, data: str):
+        if self.link is not None:
+            self.link[1].append(data)
+
+    def start(self, tag: str, attrs: dict[str, str | None]):
+        pass
+
+    def end(self, tag: str):
+        pass
+
+
+@dataclass
+class Cell:
+    depth: int
+    text: list[str] = field(default_factory=list)
+    href: str | None = None
+
+
+@dataclass
+class Row:
+    depth: int
+    cells: list[Cell] = field(default_factory=list)
+    votes: bool = False
+
+
+class ToplistParser(PageParser):
+    """
+    Finds the table with the "Place" header of a CSDb top list, and
+    collects the cells of its rows. Parsing stops when the table ends.
+    """
+
+    votes = re.compile("votes")
+
+    def __init__(self):
+        super().__init__()
+        # Position in `open` of the table, once found
+        self.table: int | None = None
+        self.rows: list[Row] = []
+        self.open_rows: list[Row] = []
+        self.cells: list[Cell] = []
+        # What is inside each open <b>; text, and True/False for start/end
+        # tags, to tell if it has a single string
+        self.bold: list[list[str | bool]] = []
+
+    def in_table(self, depth: int) -> bool:
+        return self.table is not None and depth > self.table
+
+    def start(self, tag: str, attrs: dict[str, str | None]):
+        for b in self.bold:
+            b.append(True)
+        depth = len(self.open)
+        if tag == "b":
+            self.bold.append([])
+        elif tag == "tr":
+            row = Row(depth)
+            self.open_rows.append(row)
+            if self.in_table(depth):
+                self.rows.append(row)
+        elif tag == "td" and self.in_table(depth):
+            cell = Cell(depth)
+            self.cells.append(cell)
+            for row in self.open_rows:
+                if self.in_table(row.depth):
+                    row.cells.append(cell)
+        elif tag == "a":
+            for cell in self.cells:
+                if cell.href is None:
+                    cell.href = attrs.get("href") or ""
+
+    def end(self, tag: str):
+        depth = len(self.open)
+        if tag == "b":
+            self.end_bold(self.bold.pop())
+        elif tag == "tr":
+            self.open_rows.pop()
+        elif tag == "td" and self.cells and self.cells[-1].depth == depth:
+            self.cells.pop()
+        elif tag == "table" and self.table == depth:
+            self.find_next()
+        for b in self.bold:
+            b.append(False)
+
+    def end_bold(self, content: list[str | bool]):
+        # Same as `.string` in BeautifulSoup; there must be a single text,
+        # possibly inside other tags that hold nothing else
+        k = len(content) // 2
+        text = content[k] if len(content) % 2 == 1 else None
+        if not isinstance(text, str) or content != [True] * k + [text] + [False] * k:
+            return
+        if self.table is None and text == "Place" and "table" in self.open:
+            self.table = len(self.open) - self.open[::-1].index("table") - 1
+            for row in self.open_rows:
+                if self.in_table(row.depth):
+                    self.rows.append(row)
+        if self.votes.search(text):
+            for row in self.open_rows:
+                row.votes = True
+
+    def handle_data(self, data: str):
+        super().handle_data(data)
+        for b in self.bold:
+            b.append(data)
+        for cell in self.cells:
+            cell.text.append(data)
+
+    def handle_comment(self, data: str):
+        for b in self.bold:
+            b.append(False)
+
+
+def toplist_rows(
+    html: str,
+) -> tuple[list[list[tuple[str, str | None]]] | None, str | None]:
+    """
+    The rows after the header of the top list table in `html`, as
+    (text, first link) for each cell, and the link to the next page if
+    there is one. No rows if there is no such table.
+    """
+    parser = ToplistParser()
+    parser.parse(html)
+    if parser.table is None:
+        return None, None
+    rows: list[list[tuple[str, str | None]]] = []
+    ok = False
+    for row in parser.rows:
+        if ok:
+            rows.append([("".join(c.text), c.href) for c in row.cells])
+        else:
+            ok = row.votes
+    return rows, parser.next
+
+
+class SearchParser(PageParser):
+    """
+    Gets the `og:url` of a CSDb search page, and the first link of each
+    item in its first list. Parsing stops at an `og:url` that points to a
+    single id (CSDb skips the result list when there is only one hit), or
+    else when the list ends.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.url: str | None = None
+        # Position in `open` of the list, once found
+        self.list: int | None = None
+        self.items: list[Cell] = []
+        self.open_items: list[Cell] = []
+
+    def start(self, tag: str, attrs: dict[str, str | None]):
+        if tag == "meta" and self.url is None and attrs.get("property") == "og:url":
+            self.url = attrs.get("content") or ""
+            if single_id(self.url) is not None:
+                raise Done
+        elif tag == "ol" and self.list is None:
+            self.list = len(self.open)
+        elif tag == "li" and self.list is not None:
+            item = Cell(len(self.open))
+            self.items.append(item)
+            self.open_items.append(item)
+        elif tag == "a":
+            for item in self.open_items:
+                if item.href is None:
+                    item.href = attrs.get("href") or ""
+
+    def end(self, tag: str):
+        items = self.open_items
+        if tag == "li" and items and items[-1].depth == len(self.open):
+            items.pop()
+        elif tag == "ol" and self.list == len(self.open):
+            self.find_next()
+
+
+def single_id(url: str) -> int | None:
+    """The id in a CSDb page URL like `https://csdb.dk/group/?id=7`"""
+    parts = url.split("=")
+    if len(parts) > 1 and parts[0].endswith("/?id"):
+        return int(parts[1])
+    return None
+
+
+def search_ids(html: str) -> tuple[int | None, list[int], str | None]:
+    """
+    What a CSDb search page found; the id the page is about if there was
+    a single hit, and otherwise the ids in the list of results and the
+    link to the next page of them (if any).
+    """
+    parser = SearchParser()
+    parser.parse(html)
+    if parser.url is not None:
+        id = single_id(parser.url)
+        if id is not None:
+            return id, [], None
+    ids: list[int] = []
+    for item in parser.items:
+        if item.href is None:
+            continue
+        parts = item.href.split("=")
+        if parts[1].isdigit():
+            ids.append(int(parts[1]))
+    return None, ids, parser.next
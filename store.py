@@ -0,0 +1,299 @@
+#!/usr/bin/python
+
+import html
+import os
+import re
+import sqlite3
+import threading
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+schema = """
+CREATE TABLE IF NOT EXISTS xml (
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    fetched REAL NOT NULL,
+    etag TEXT,
+    modified TEXT,
+    PRIMARY KEY (kind, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS parsed (
+    id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS names (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (kind, key, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trigrams (
+    kind TEXT NOT NULL,
+    trigram TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (kind, trigram, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS indexed (
+    source TEXT PRIMARY KEY,
+    stamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+"""
+
+
+# Named things (and their alternative names) anywhere in webservice XML
+named = re.compile(
+    rb"<(Group|Event|Release)><ID>(\d+)</ID>\s*<Name>([^<]*)</Name>"
+    rb"(?:\s*<AKA>([^<]*)</AKA>)?"
+)
+
+
+def name_key(name: str) -> str:
+    """Normalized name, for lookups"""
+    return " ".join(name.casefold().split())
+
+
+def trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def extract_names(data: bytes) -> set[tuple[str, str, int]]:
+    """All (kind, name key, id) in webservice XML `data`"""
+    names: set[tuple[str, str, int]] = set()
+    for m in named.finditer(data):
+        kind = m[1].decode().lower()
+        id = int(m[2])
+        for name in [m[3], *(m[4] or b"").split(b", ")]:
+            key = name_key(html.unescape(name.decode(errors="replace")))
+            if key:
+                names.add((kind, key, id))
+    return names
+
+
+@dataclass
+class Entry:
+    """Cached webservice XML, and when and how it was fetched"""
+
+    data: bytes
+    fetched: float
+    etag: str | None = None
+    modified: str | None = None
+
+
+class MetaStore:
+    """
+    Single file (SQLite) store for CSDb webservice XML, keyed by
+    kind ("release", "group", "event") and id.
+
+    Each thread gets its own connection, and the database runs in WAL mode
+    so readers don't block the writer.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.local = threading.local()
+
+    def db(self) -> sqlite3.Connection:
+        con: sqlite3.Connection | None = getattr(self.local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.executescript(schema)
+            self.local.con = con
+        return con
+
+    def get(self, kind: str, id: int) -> Entry | None:
+        row = (
+            self.db()
+            .execute(
+                "SELECT data, fetched, etag, modified FROM xml WHERE kind=? AND id=?",
+                (kind, id),
+            )
+            .fetchone()
+        )
+        return Entry(*row) if row is not None else None
+
+    def put(self, kind: str, id: int, entry: Entry):
+        con = self.db()
+        con.execute(
+            "INSERT OR REPLACE INTO xml VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, id, entry.data, entry.fetched, entry.etag, entry.modified),
+        )
+        if kind == "release":
+            con.execute("DELETE FROM parsed WHERE id=?", (id,))
+        self.add_names(extract_names(entry.data))
+
+    def add_names(self, names: Iterable[tuple[str, str, int]]):
+        names = list(names)
+        con = self.db()
+        con.executemany("INSERT OR IGNORE INTO names VALUES (?, ?, ?)", names)
+        con.executemany(
+            "INSERT OR IGNORE INTO trigrams VALUES (?, ?, ?)",
+            (
+                (kind, t, key)
+                for kind, key in {(kind, key) for kind, key, _ in names}
+                for t in trigrams(key)
+            ),
+        )
+
+    def index_names(self, source: str, stamp: str, data: Iterable[bytes]) -> bool:
+        """
+        Add the names in all XML documents of `data`, unless `source` was
+        already indexed with the same `stamp`. `data` is only read if needed.
+        """
+        con = self.db()
+        row = con.execute(
+            "SELECT stamp FROM indexed WHERE source=?", (source,)
+        ).fetchone()
+        if row is not None and row[0] == stamp:
+            return False
+        names: set[tuple[str, str, int]] = set()
+        for xml in data:
+            names |= extract_names(xml)
+        con.execute("BEGIN")
+        self.add_names(names)
+        con.execute("INSERT OR REPLACE INTO indexed VALUES (?, ?)", (source, stamp))
+        con.execute("COMMIT")
+        return True
+
+    def _name_ids(self, kind: str, key: str, prefix: bool = False) -> set[int]:
+        if prefix:
+            rows = self.db().execute(
+                "SELECT id FROM names WHERE kind=? AND key>=? AND key<?",
+                (kind, key, key + "\U0010ffff"),
+            )
+        else:
+            rows = self.db().execute(
+                "SELECT id FROM names WHERE kind=? AND key=?", (kind, key)
+            )
+        return {id for (id,) in rows}
+
+    def find_name(self, kind: str, name: str) -> list[int]:
+        """
+        Ids of `kind` things called `name`, or if there are none, of those
+        with names starting with `name`.
+        """
+        key = name_key(name)
+        ids = self._name_ids(kind, key) or self._name_ids(kind, key, prefix=True)
+        return sorted(ids)
+
+    def similar_names(
+        self, kind: str, name: str, min_score: float = 0.4, limit: int = 3
+    ) -> list[str]:
+        """
+        Names (as keys) of `kind` things that share at least `min_score` of
+        their trigrams with `name`, most similar first.
+        """
+        wanted = trigrams(name_key(name))
+        rows = self.db().execute(
+            "SELECT key, COUNT(*) FROM trigrams WHERE kind=? AND trigram IN"
+            f" ({', '.join('?' * len(wanted))}) GROUP BY key",
+            (kind, *wanted),
+        )
+        scored: list[tuple[float, str]] = []
+        for key, shared in rows:
+            score = shared / (len(wanted) + len(trigrams(key)) - shared)
+            if score >= min_score:
+                scored.append((-score, key))
+        return [key for _, key in sorted(scored)[:limit]]
+
+    def entries(self) -> Iterator[tuple[str, int, Entry]]:
+        rows = self.db().execute(
+            "SELECT kind, id, data, fetched, etag, modified FROM xml"
+        )
+        for kind, id, *fields in rows:
+            yield kind, id, Entry(*fields)
+
+    def touch(self, kind: str, id: int, fetched: float) -> bool:
+        """
+        Mark entry as checked (but unchanged) at `fetched`.
+        Returns False if there is no such entry.
+        """
+        con = self.db()
+        cur = con.execute(
+            "UPDATE xml SET fetched=? WHERE kind=? AND id=?", (fetched, kind, id)
+        )
+        if kind == "release":
+            con.execute("UPDATE parsed SET fetched=? WHERE id=?", (fetched, id))
+        return cur.rowcount > 0
+
+    def get_parsed(self, id: int, version: int) -> tuple[str, float] | None:
+        """
+        Get a serialized release parsed with parser `version`, and the fetch
+        time of the XML it was parsed from.
+        """
+        row = (
+            self.db()
+            .execute(
+                "SELECT data, fetched FROM parsed WHERE id=? AND version=?",
+                (id, version),
+            )
+            .fetchone()
+        )
+        return (row[0], row[1]) if row is not None else None
+
+    def put_parsed(self, id: int, version: int, fetched: float, data: str):
+        self.db().execute(
+            "INSERT OR REPLACE INTO parsed VALUES (?, ?, ?, ?)",
+            (id, version, fetched, data),
+        )
+
+    def get_page(self, kind: str, key: str) -> tuple[str, float] | None:
+        """
+        Get what was scraped from a CSDb page (serialized), and when.
+        `kind` is the kind of page (ie "search"), `key` what identifies it.
+        """
+        row = (
+            self.db()
+            .execute(
+                "SELECT data, fetched FROM pages WHERE kind=? AND key=?", (kind, key)
+            )
+            .fetchone()
+        )
+        return (row[0], row[1]) if row is not None else None
+
+    def put_page(self, kind: str, key: str, fetched: float, data: str):
+        self.db().execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+            (kind, key, fetched, data),
+        )
+
+    def ids(self, kind: str) -> set[int]:
+        rows = self.db().execute("SELECT id FROM xml WHERE kind=?", (kind,))
+        return {id for (id,) in rows}
+
+    def import_dir(self, kind: str, path: Path) -> int:
+        """
+        Import all `<id>.xml` files from an old style cache directory (ie
+        `.releases/`), using the file time as the fetch time. Entries that
+        are already in the store are left alone. Returns number of imported
+        entries.
+        """
+        rows: list[tuple[str, int, bytes, float, None, None]] = []
+        for e in os.scandir(path):
+            name, ext = os.path.splitext(e.name)
+            if ext != ".xml" or not name.isdigit():
+                continue
+            data = Path(e.path).read_bytes()
+            rows.append((kind, int(name), data, e.stat().st_mtime, None, None))
+        con = self.db()
+        before = con.total_changes
+        con.execute("BEGIN")
+        con.executemany("INSERT OR IGNORE INTO xml VALUES (?, ?, ?, ?, ?, ?)", rows)
+        count = con.total_changes - before
+        for row in rows:
+            self.add_names(extract_names(row[2]))
+        con.execute("COMMIT")
+        return count
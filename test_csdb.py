@@ -1,13 +1,266 @@
+import re
+import time
+import xml.etree.ElementTree as ET
+from dataclasses import asdict
 from pathlib import Path
-from bs4 import BeautifulSoup
-from csdb import search_soup
+
+import pytest
+
+import csdb
+import utils
+from conftest import Handler, file_data
+from csdb import (
+    Link,
+    download_releases,
+    find_ids,
+    get_links_from_csdb_page,
+    get_csdb_xml,
+    populate_release,
+    populate_releases,
+    search,
+    search_page,
+    set_revalidate,
+)
+from store import Entry, MetaStore
+from tools64 import Release
+
 
 def test_search():
     t = Path("testdata/oxyron.html").read_text()
-    soup = BeautifulSoup(t, "html.parser")
-    result = search_soup(soup)
-    assert len(result) == 1 and result[0] == 7
+    assert search_page(t) == ([7], None)
     t = Path("testdata/crackers.html").read_text()
-    soup = BeautifulSoup(t, "html.parser")
-    result = search_soup(soup)
-    assert len(result) > 10
\ No newline at end of file
+    result, next = search_page(t)
+    assert len(result) == 25 and len(set(result)) == 25
+    assert next == "?seinsel=groups&search=Crackers&all=1"
+
+
+def test_toplist():
+    html = Path("testdata/toplist.html").read_text()
+    links, next = get_links_from_csdb_page(html)
+    assert len(links) == 100 and next is None
+    assert links[0] == Link(125822, 1, 9.79, "Uncensored by Fairlight")
+    # Tied releases have no place of their own
+    assert links[4].place == links[3].place == 4
+    assert links[5].name == "Rocket & Science by Booze Design"
+    assert links[7] == Link(8744, 8, 9.75, "Boogie Factor by Fairlight")
+
+
+def test_pagination(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    crackers = Path("testdata/crackers.html").read_text()
+    all_crackers = crackers.replace(
+        "</ol>", '<li><a href="/group/?id=64">Zoo Crackers</a></li></ol>'
+    ).replace("Show all", "All")
+    toplist = Path("testdata/toplist.html").read_text()
+    more = "</table><a href='toplist.php?type=release&subtype=(1)&start=100'>Next</a>"
+    pages = {
+        "/search/?seinsel=groups&search=Crackers": crackers,
+        "/search/?seinsel=groups&search=Crackers&all=1": all_crackers,
+        "/toplist.php?type=release&subtype=(1)": toplist.replace("</table>", more),
+        "/toplist.php?type=release&subtype=(1)&start=100": toplist,
+    }
+    fetched: list[str] = []
+
+    def get_html(url: str) -> str:
+        path = url.removeprefix(csdb.csdb_url)
+        fetched.append(path)
+        return pages[path]
+
+    monkeypatch.setattr(csdb, "get_html", get_html)
+    monkeypatch.setattr(csdb, "store", MetaStore(tmp_path / "meta.sqlite"))
+
+    # The next page is fetched while the first one is used
+    results = csdb.search_pages("groups", "Crackers")
+    assert len(next(results)) == 25
+    for _ in range(100):
+        if len(fetched) == 2:
+            break
+        time.sleep(0.01)
+    assert fetched == list(pages)[:2]
+    # ...and only what was not on the first page is new
+    assert next(results) == [64]
+    assert len(list(search("groups", "Crackers"))) == 26
+    assert len(fetched) == 2
+
+    links = list(csdb.toplist_links("demo"))
+    assert len(links) == 200 and links[100] == links[0]
+    assert fetched[2:] == list(pages)[2:]
+
+    # Next links back to a page we have seen end the list
+    loop = "</table><a href='toplist.php?type=release&subtype=(2)'>Next</a>"
+    pages["/toplist.php?type=release&subtype=(2)"] = toplist.replace("</table>", loop)
+    links = list(csdb.toplist_links("onefile"))
+    assert len(links) == 100
+    assert fetched[4:] == ["/toplist.php?type=release&subtype=(2)"]
+
+
+def test_populate_releases(monkeypatch: pytest.MonkeyPatch):
+    def fake_populate(link: Link) -> Release | None:
+        time.sleep((link.id % 3) * 0.01)
+        return None if link.id == 3 else Release(link.id, year=1990 + link.id)
+
+    monkeypatch.setattr(csdb, "populate_release", fake_populate)
+    links = [Link(i) for i in range(20)]
+    rels = populate_releases(links, lambda _, r: r.id % 2 == 1, 4, jobs=4)
+    assert [r.id for r in rels] == [1, 5, 7, 9]
+
+
+def test_page_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    pages: list[str] = []
+
+    def get_html(url: str) -> str:
+        pages.append(url)
+        return Path("testdata/oxyron.html").read_text()
+
+    monkeypatch.setattr(csdb, "get_html", get_html)
+    monkeypatch.setattr(csdb, "store", MetaStore(tmp_path / "meta.sqlite"))
+    assert list(search("groups", "Oxyron")) == [7]
+    assert list(search("groups", "Oxyron")) == [7]
+    assert list(search("groups", "oxyron")) == [7]
+    assert len(pages) == 2
+
+    monkeypatch.setattr(csdb, "refresh_pages", True)
+    assert list(search("groups", "Oxyron")) == [7]
+    monkeypatch.setattr(csdb, "refresh_pages", False)
+    monkeypatch.setitem(csdb.page_ttl, "search", 0)
+    assert list(search("groups", "Oxyron")) == [7]
+    assert len(pages) == 4
+
+    # Names in cached metadata don't need a search
+    xml = Path("testdata/release.xml").read_bytes()
+    csdb.store.put("release", 72550, Entry(xml, time.time()))
+    assert find_ids("group", "Booze Design") == [1003]
+    assert find_ids("event", "X'2008") == [1410]
+    assert list(find_ids("group", "Oxyron")) == [7]
+    assert len(pages) == 5
+    # Names that are only similar are searched for
+    assert list(find_ids("group", "Booze Design Crew")) == [7]
+    assert len(pages) == 6
+
+
+def test_revalidate(server: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(csdb, "csdb_url", server)
+    monkeypatch.setattr(csdb, "store", MetaStore(tmp_path / "meta.sqlite"))
+    monkeypatch.setattr(csdb, "revalidate_age", None)
+    Handler.xml_requests = 0
+    Handler.xml_version = 1
+
+    assert get_csdb_xml("group", 1).findtext("./Group/Name") == "Version 1"
+    assert get_csdb_xml("group", 1).findtext("./Group/Name") == "Version 1"
+    assert Handler.xml_requests == 1
+
+    set_revalidate(3600)
+    get_csdb_xml("group", 1)
+    assert Handler.xml_requests == 1
+
+    # Not modified
+    set_revalidate(0)
+    before = csdb.store.get("group", 1)
+    assert get_csdb_xml("group", 1).findtext("./Group/Name") == "Version 1"
+    assert Handler.xml_requests == 2
+    after = csdb.store.get("group", 1)
+    assert before is not None and after is not None
+    assert after.data == before.data and after.fetched > before.fetched
+
+    Handler.xml_version = 2
+    assert get_csdb_xml("group", 1).findtext("./Group/Name") == "Version 2"
+    assert Handler.xml_requests == 3
+
+
+def test_missing_id(server: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(csdb, "csdb_url", server)
+    monkeypatch.setattr(csdb, "store", MetaStore(tmp_path / "meta.sqlite"))
+    Handler.xml_requests = 0
+
+    assert get_csdb_xml("group", 404).find("./Group") is None
+    assert populate_release(Link(404)) is None
+    assert Handler.xml_requests == 2
+    assert populate_release(Link(404)) is None
+    assert Handler.xml_requests == 2
+    utils.set_retry_window(0)
+    assert populate_release(Link(404)) is None
+    assert Handler.xml_requests == 3
+
+
+def test_download_releases(
+    server: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    def fake_unpack(file: Path, udir: Path, d64_to_prg: bool):
+        udir.mkdir(parents=True, exist_ok=True)
+        if file.name.endswith("file.zip"):
+            (udir / "file.prg").write_bytes(file.read_bytes())
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(csdb, "unpack", fake_unpack)
+    good = [f"{server}/missing.zip", f"{server}/file.zip"]
+    releases = [Release(i, title=f"R{i}", downloads=good) for i in range(6)]
+    releases.append(Release(6, title="R6", downloads=[f"{server}/missing.zip"]))
+    releases.append(Release(7, title="R7", downloads=[f"{server}/other.zip"]))
+
+    unpacked = download_releases(
+        iter(releases), "out/{title}", False, download_jobs=2, unpack_jobs=3
+    )
+    assert unpacked == 6
+    assert (tmp_path / "out" / "R5" / "file.prg").read_bytes() == file_data
+    assert list((tmp_path / "out" / "R6").iterdir()) == []
+    assert utils.recent_failure(f"{server}/missing.zip") == "HTTP 404"
+    assert utils.recent_failure(f"{server}/other.zip") == "Nothing to unpack"
+
+
+def test_parse_release():
+    xml = Path("testdata/release.xml").read_text()
+    rel = csdb.parse_release(ET.fromstring(xml))
+    assert rel == Release(
+        rating=9.72,
+        title="Edge of Disgrace",
+        group="Booze Design",
+        groups=["Booze Design"],
+        downloads=[
+            "https://csdb.dk/getinternalfile.php/72550/booze_design-edge_of_disgrace.zip",
+            "https://csdb.dk/getinternalfile.php/72550/eod_with_fix.d64",
+            "http://www.boozedesign.org/files/edge_of_disgrace.zip",
+        ],
+        event="X'2008",
+        place=1,
+        compo="C64 Demo",
+        year=2008,
+        type="C64 Demo",
+    )
+
+    # Without groups the handles are used, and missing fields get defaults
+    xml = re.sub(r"<Group>.*?</Group>|<Achievement>.*?</Achievement>", "", xml, 0, re.S)
+    xml = xml.replace("<Rating>9.72</Rating>", "")
+    rel = csdb.parse_release(ET.fromstring(xml))
+    assert rel is not None and rel.groups == ["HCL"] and rel.group == "HCL"
+    assert (rel.place, rel.compo, rel.rating) == (-1, "No Compo", -1)
+    assert csdb.parse_release(ET.fromstring("<CSDbData><Release/></CSDbData>")) is None
+
+
+def test_parsed_release_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    parsed: list[int] = []
+
+    def parse_release(tree: ET.Element) -> Release | None:
+        parsed.append(1)
+        return csdb_parse_release(tree)
+
+    csdb_parse_release = csdb.parse_release
+    monkeypatch.setattr(csdb, "parse_release", parse_release)
+    monkeypatch.setattr(csdb, "store", MetaStore(tmp_path / "meta.sqlite"))
+    xml = Path("testdata/release.xml").read_bytes()
+    csdb.store.put("release", 72550, Entry(xml, time.time()))
+    csdb.store.put("release", 1, Entry(b"<CSDbData><Release/></CSDbData>", time.time()))
+
+    rel = populate_release(Link(72550, 3))
+    assert rel is not None and rel.title == "Edge of Disgrace" and rel.rank == 3
+    assert populate_release(Link(72550, 4)) == Release(**(asdict(rel) | {"rank": 4}))
+    assert populate_release(Link(1)) is None
+    assert populate_release(Link(1)) is None
+    assert len(parsed) == 2
+
+    # Changed XML or parser means parsing again
+    csdb.store.put("release", 72550, Entry(xml.replace(b"2008<", b"2009<"), 0))
+    rel = populate_release(Link(72550))
+    assert rel is not None and rel.year == 2009
+    monkeypatch.setattr(csdb, "parser_version", csdb.parser_version + 1)
+    populate_release(Link(72550))
+    assert len(parsed) == 4
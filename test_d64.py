@@ -0,0 +1,146 @@
+import gzip
+import shutil
+import subprocess
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from d64 import D64, D64Writer, petscii, petscii_name
+from tools64 import unpack
+from utils import temp_dir
+
+
+@pytest.fixture
+def skaaneland() -> bytes:
+    """Side 2 of Skaaneland; 5 PRGs and some DEL files for decoration"""
+    with zipfile.ZipFile("testdata/skaaneland.zip") as zf:
+        return gzip.decompress(zf.read("Skaaneland [Side 2].d64.gz"))
+
+
+def test_directory(skaaneland: bytes):
+    d64 = D64(skaaneland)
+    assert d64.tracks == 35 and d64.error(1, 0) == 1
+    assert d64.name == b" ->ZYRON'S PD<- "
+    files = [(e.name, e.type, e.blocks) for e in d64.directory() if e.type != "DEL"]
+    assert files == [
+        (b"F7.  8TH YEAR   ", "PRG", 71),
+        (b"P1.     OF      ", "PRG", 53),
+        (b"P2.   GLORY!    ", "PRG", 53),
+        (b"P3.             ", "PRG", 56),
+        (b"P4. -FAIRLIGHT- ", "PRG", 25),
+    ]
+    for entry in d64.directory():
+        if entry.type == "PRG":
+            data = d64.read(entry)
+            assert (len(data) + 253) // 254 == entry.blocks
+
+    # 40 tracks and error bytes
+    d64 = D64(skaaneland + bytes(5 * 17 * 256) + bytes([1] * 767 + [5]))
+    assert d64.tracks == 40 and d64.error(40, 16) == 5
+    with pytest.raises(ValueError):
+        D64(skaaneland[:-1])
+
+    assert petscii_name(b"CHARLATAN.BEYOND") == "charlatan.beyond"
+    assert petscii_name(b"SKAANELAND  /FLT") == "skaaneland  _flt"
+    assert petscii_name(b"\xc1\x42\x5c\x12") == "Ab__"
+
+
+def test_broken_chain(skaaneland: bytes):
+    data = bytearray(skaaneland)
+    d64 = D64(data)
+    entry = next(e for e in d64.directory() if e.name.startswith(b"P4"))
+    # Point the first sector of the file to itself
+    offset = d64.index(entry.track, entry.sector) * 256
+    data[offset : offset + 2] = bytes([entry.track, entry.sector])
+    with pytest.raises(ValueError):
+        d64.read(entry)
+    data[offset : offset + 2] = bytes([36, 0])
+    with pytest.raises(ValueError):
+        d64.read(entry)
+
+
+def test_d64_to_prg():
+    with temp_dir() as out:
+        unpack(Path("testdata/skaaneland.zip"), out, d64_to_prg=True)
+        names = sorted(f.name for f in out.iterdir())
+        assert len(names) == 12 and "p4. -fairlight- .prg" in names
+        assert (out / "p4. -fairlight- .prg").read_bytes()[:2] == b"\x00\x80"
+
+
+def programs() -> list[tuple[str, bytes]]:
+    return [(f"part{i}", bytes([1, 8, i]) * (i * 250 + 1)) for i in range(12)] + [
+        ("empty", b""),
+        ("Hello World", b"\x01\x08" + bytes(252)),
+    ]
+
+
+def test_write_d64(skaaneland: bytes):
+    disk = D64Writer(petscii("Demo 2024"), b"64")
+    for name, data in programs():
+        disk.add(petscii(name), data)
+    image = disk.finish()
+    assert len(image) == 174848
+
+    d64 = D64(image)
+    assert petscii_name(d64.name) == "Demo 2024"
+    entries = list(d64.directory())
+    assert [(petscii_name(e.name), d64.read(e)) for e in entries] == [
+        (name, data) for name, data in programs()
+    ]
+    # Free blocks in the BAM add up
+    bam = d64.sector(18, 0)
+    free = sum(bam[track * 4] for track in range(1, 36) if track != 18)
+    assert free + sum(e.blocks for e in entries) == 664
+
+    # Only what fits
+    disk = D64Writer(b"FULL")
+    disk.add(b"BIG", bytes(254 * 664))
+    with pytest.raises(ValueError):
+        disk.add(b"MORE", b"\x01\x08")
+    disk = D64Writer(b"MANY")
+    with pytest.raises(ValueError):
+        for i in range(145):
+            disk.add(b"%d" % i, b"")
+
+    # The files of a real disk survive a round trip
+    d64 = D64(skaaneland)
+    disk = D64Writer(d64.name)
+    files = [(e.name, d64.read(e)) for e in d64.directory() if e.type == "PRG"]
+    for name, data in files:
+        disk.add(name, data)
+    copy = D64(disk.finish())
+    assert [(e.name, copy.read(e)) for e in copy.directory()] == files
+
+
+@pytest.mark.skipif(shutil.which("cbmconvert") is None, reason="needs cbmconvert")
+def test_cbmconvert_d64(tmp_path: Path):
+    names: list[str] = []
+    disk = D64Writer(b"TEST")
+    for name, data in programs()[:12]:
+        (tmp_path / f"{name}.prg").write_bytes(data)
+        names.append(f"{name}.prg")
+        disk.add(petscii(name), data)
+    args = ["cbmconvert", "-n", "-D4", "cbm.d64", *names]
+    subprocess.run(args, cwd=tmp_path, check=True, capture_output=True)
+
+    def files(d64: D64) -> list[tuple[str, bytes]]:
+        return [(petscii_name(e.name).lower(), d64.read(e)) for e in d64.directory()]
+
+    cbm = D64((tmp_path / "cbm.d64").read_bytes())
+    ours = D64(disk.finish())
+    assert files(ours) == files(cbm)
+    free = [sum(d.sector(18, 0)[4:0x90:4]) for d in (ours, cbm)]
+    assert free[0] == free[1]
+
+
+def test_prg_to_d64(tmp_path: Path):
+    with zipfile.ZipFile(tmp_path / "Some Demo.zip", "w") as zf:
+        for name, data in programs():
+            zf.writestr(f"{name}.prg", data)
+    with temp_dir() as out:
+        unpack(tmp_path / "Some Demo.zip", out, prg_to_d64=True)
+        assert [f.name for f in out.iterdir()] == ["Some Demo.d64"]
+        d64 = D64((out / "Some Demo.d64").read_bytes())
+        assert petscii_name(d64.name) == "Some Demo"
+        assert len(list(d64.directory())) == len(programs())
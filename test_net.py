@@ -0,0 +1,104 @@
+import http.client
+import socket
+import urllib.error
+
+import pytest
+
+from conftest import Handler
+from net import ConnectTimeout, RateLimiter, Session
+
+
+def test_keep_alive(server: str):
+    s = Session()
+    for _ in range(5):
+        assert s.fetch(f"{server}/data") == b"x" * 1000
+    assert s.stats.opened == 1
+    assert s.stats.reused == 4
+
+
+def test_partial_read_not_reused(server: str):
+    s = Session()
+    with s.open(f"{server}/data") as resp:
+        assert resp.read(10) == b"x" * 10
+    s.fetch(f"{server}/data")
+    assert s.stats.opened == 2
+
+
+def test_no_body_reused(server: str):
+    s = Session()
+    url = f"{server}/webservice/?type=group&id=1&depth=2"
+    with s.open(url) as resp:
+        etag = resp.headers["ETag"]
+        resp.read()
+    with s.open(url, {"If-None-Match": etag}) as resp:
+        assert resp.status == 304
+    s.fetch(url)
+    assert s.stats.opened == 1 and s.stats.reused == 2
+
+
+def test_redirect_and_errors(server: str):
+    s = Session()
+    assert s.fetch(f"{server}/redirect") == b"x" * 1000
+    with pytest.raises(urllib.error.HTTPError) as e:
+        s.fetch(f"{server}/missing")
+    assert e.value.code == 404
+    with pytest.raises(ValueError):
+        s.fetch("no/scheme")
+    assert s.stats.opened == 1
+
+
+def test_broken_body(server: str):
+    s = Session(timeout=0.2)
+    with pytest.raises(urllib.error.URLError) as e:
+        s.fetch(f"{server}/stall")
+    assert isinstance(e.value.reason, TimeoutError)
+    with pytest.raises(urllib.error.URLError) as e:
+        s.fetch(f"{server}/short.zip")
+    assert isinstance(e.value.reason, http.client.IncompleteRead)
+    assert s.fetch(f"{server}/data") == b"x" * 1000
+
+
+def test_throttled_retry(server: str):
+    s = Session(retries=2)
+    s.limiter = RateLimiter(rate=100, backoff=0.01)
+    Handler.busy = 2
+    assert s.fetch(f"{server}/busy") == b"x" * 1000
+    b = s.limiter.buckets["127.0.0.1"]
+    assert b.throttled == 2 and b.requests == 4
+    Handler.busy = 3
+    with pytest.raises(urllib.error.HTTPError) as e:
+        s.fetch(f"{server}/busy")
+    assert e.value.code == 503
+
+
+def test_connect_timeout():
+    # A server that doesn't accept; connects hang once its backlog is full
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    waiting = [socket.create_connection(("127.0.0.1", port), timeout=5)]
+    s = Session(connect_timeout=0.2)
+    s.limiter = RateLimiter(backoff=0.01)
+    with pytest.raises(urllib.error.URLError) as e:
+        s.fetch(f"http://127.0.0.1:{port}/data")
+    assert isinstance(e.value.reason, ConnectTimeout)
+    assert s.limiter.buckets["127.0.0.1"].requests == 2
+    for c in waiting + [listener]:
+        c.close()
+
+
+def test_rate_limiter():
+    r = RateLimiter(rate=8, backoff=0.01)
+    r.set_limit("slow", 2)
+    for _ in range(4):
+        r.acquire("fast")
+    r.acquire("slow")
+    assert r.buckets["slow"].max_rate == 2
+    assert r.buckets["fast"].waited == 0
+    r.failure("fast")
+    r.failure("fast")
+    assert r.buckets["fast"].rate == 2
+    r.success("fast")
+    assert r.buckets["fast"].rate == pytest.approx(2.8)
+    assert r.buckets["fast"].failures == 0
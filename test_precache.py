@@ -0,0 +1,91 @@
+import zlib
+from pathlib import Path
+
+import pytest
+
+import csdb
+from precache import Pack, append_pack, record, trailer, write_pack
+from store import Entry, MetaStore
+
+
+def test_pack(tmp_path: Path):
+    entries = [
+        ("release", 5, Entry(b"<five/>", 100)),
+        ("group", 1, Entry(b"<g1/>", 200)),
+        ("release", 2, Entry(b"<two/>", 300)),
+        ("event", 9, Entry(b"<e9/>" * 100, 400)),
+        ("release", 5, Entry(b"<five again/>", 500)),
+    ]
+    assert write_pack(tmp_path / "test.pack", entries) == 4
+    pack = Pack(tmp_path / "test.pack")
+    assert len(pack) == 4
+    assert pack.get("release", 5) == Entry(b"<five again/>", 500)
+    assert pack.get("event", 9) == Entry(b"<e9/>" * 100, 400)
+    assert pack.get("release", 1) is None
+    assert pack.get("group", 2) is None
+    assert pack.get("event", 10) is None
+    assert pack.ids("release") == {2, 5}
+    assert [(k, i) for k, i, _ in pack] == [
+        ("release", 2),
+        ("release", 5),
+        ("group", 1),
+        ("event", 9),
+    ]
+
+    (tmp_path / "bad.pack").write_bytes(b"CSDBPAK1" + b"\0" * 20)
+    with pytest.raises(ValueError):
+        Pack(tmp_path / "bad.pack")
+
+
+def test_append_pack(tmp_path: Path):
+    path = tmp_path / "test.pack"
+    write_pack(
+        path, [("release", 1, Entry(b"<a/>", 1)), ("group", 1, Entry(b"<a/>", 2))]
+    )
+    old = Pack(path)
+    size = path.stat().st_size
+    entries = [("release", 1, Entry(b"<b/>", 3)), ("event", 2, Entry(b"<b/>", 4))]
+    assert append_pack(path, entries) == 2
+    # Same data is only stored once
+    added = len(zlib.compress(b"<b/>", 9)) + 3 * record.size + trailer.size
+    assert path.stat().st_size == size + added
+
+    pack = Pack(path)
+    assert len(pack) == 3
+    assert pack.get("release", 1) == Entry(b"<b/>", 3)
+    assert pack.get("group", 1) == Entry(b"<a/>", 2)
+    assert pack.get("event", 2) == Entry(b"<b/>", 4)
+    assert old.get("release", 1) == Entry(b"<a/>", 1)
+    assert append_pack(path, []) == 0
+    assert Pack(path).fetched("event", 2) == 4
+
+
+def test_export(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(csdb, "store", MetaStore(tmp_path / "meta.sqlite"))
+    path = tmp_path / "precache.pack"
+    csdb.store.put("release", 1, Entry(b"<one/>", 10))
+    csdb.store.put("release", 2, Entry(b"<two/>", 10))
+    csdb.store.put("group", 404, Entry(csdb.missing_xml, 10))
+    assert csdb.export_precache(path) == 2
+    assert csdb.export_precache(path) == 0
+
+    csdb.store.touch("release", 1, 20)
+    csdb.store.put("release", 2, Entry(b"<new two/>", 20))
+    csdb.store.put("event", 3, Entry(b"<three/>", 20))
+    assert csdb.export_precache(path) == 2
+    pack = Pack(path)
+    assert pack.get("release", 2) == Entry(b"<new two/>", 20)
+    assert pack.get("release", 1) == Entry(b"<one/>", 10)
+    assert pack.ids("event") == {3}
+    assert csdb.export_precache(path, rebuild=True) == 3
+
+
+def test_precache_fallback(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    xml = Path("testdata/release.xml").read_bytes()
+    write_pack(tmp_path / "precache.pack", [("release", 72550, Entry(xml, 0))])
+    monkeypatch.setattr(csdb, "precache_file", tmp_path / "precache.pack")
+    monkeypatch.setattr(csdb, "precache", None)
+    monkeypatch.setattr(csdb, "store", MetaStore(tmp_path / "meta.sqlite"))
+    tree = csdb.get_csdb_xml("release", 72550)
+    assert tree.findtext("./Release/Name") == "Edge of Disgrace"
+    assert csdb.store.ids("release") == set()
@@ -0,0 +1,80 @@
+import threading
+import time
+import urllib.error
+from collections.abc import Generator
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+from conftest import file_data
+from net import RateLimiter, Session
+from replay import FixtureStore, ReplayServer
+
+
+@pytest.fixture
+def recorded(server: str, tmp_path: Path) -> FixtureStore:
+    store = FixtureStore(tmp_path / "fixtures")
+    s = Session()
+    s.hooks.append(store.record)
+    s.fetch(f"{server}/file.zip")
+    s.fetch(f"{server}/redirect")
+    with pytest.raises(urllib.error.HTTPError):
+        s.fetch(f"{server}/missing")
+    # Partially read responses are not recorded
+    with s.open(f"{server}/data") as resp:
+        resp.read(10)
+    return store
+
+
+@contextmanager
+def serve(server: ReplayServer) -> Generator[ReplayServer, None, None]:
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_record(server: str, recorded: FixtureStore):
+    assert sorted(recorded.urls()) == sorted(
+        [f"{server}/file.zip", f"{server}/redirect", f"{server}/missing"]
+    )
+    fixture = recorded.get(f"{server}/file.zip")
+    assert fixture is not None and fixture[1] == file_data
+
+
+def test_replay(server: str, recorded: FixtureStore):
+    with serve(ReplayServer(recorded, ("127.0.0.1", 0), latency=0.1)) as replay:
+        s = Session()
+        s.proxy = replay.url
+        start = time.monotonic()
+        assert s.fetch(f"{server}/file.zip") == file_data
+        assert s.fetch(f"{server}/redirect") == b"x" * 1000
+        assert time.monotonic() - start >= 0.2
+        with pytest.raises(urllib.error.HTTPError) as e:
+            s.fetch(f"{server}/data")
+        assert e.value.code == 404
+
+        headers = {"Range": "bytes=1000-"}
+        with s.open(f"{server}/file.zip", headers) as resp:
+            assert resp.status == 206
+            assert resp.read() == file_data[1000:]
+            etag = resp.headers["ETag"]
+        with s.open(f"{server}/file.zip", {"If-None-Match": etag}) as resp:
+            assert resp.status == 304
+
+
+def test_replay_errors(server: str, recorded: FixtureStore):
+    replay = ReplayServer(recorded, ("127.0.0.1", 0), bandwidth=20000, errors=1)
+    with serve(replay):
+        s = Session(retries=1)
+        s.limiter = RateLimiter(backoff=0.01)
+        s.proxy = replay.url
+        with pytest.raises(urllib.error.URLError):
+            s.fetch(f"{server}/file.zip")
+
+        replay.errors = 0
+        start = time.monotonic()
+        assert s.fetch(f"{server}/file.zip") == file_data
+        assert time.monotonic() - start >= 0.4
@@ -0,0 +1,76 @@
+import os
+import threading
+from pathlib import Path
+
+from store import Entry, MetaStore, extract_names
+
+
+def test_store(tmp_path: Path):
+    store = MetaStore(tmp_path / "meta.sqlite")
+    assert store.get("release", 1) is None
+    store.put("release", 1, Entry(b"<a/>", 10, '"x"'))
+    store.put("group", 1, Entry(b"<b/>", 20))
+    store.touch("release", 1, 30)
+    assert store.get("release", 1) == Entry(b"<a/>", 30, '"x"')
+
+    def writer(n: int):
+        for i in range(50):
+            store.put("release", n * 100 + i, Entry(b"<c/>", 0))
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(1, 5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(store.ids("release")) == 201
+    assert store.ids("group") == {1}
+
+
+def test_import_dir(tmp_path: Path):
+    cache = tmp_path / ".releases"
+    cache.mkdir()
+    (cache / "1.xml").write_text("<one/>")
+    (cache / "2.xml").write_text("<Group><ID>2</ID><Name>Two</Name></Group>")
+    (cache / "notes.txt").write_text("")
+    os.utime(cache / "2.xml", (5, 5))
+
+    store = MetaStore(tmp_path / "meta.sqlite")
+    store.put("release", 1, Entry(b"<newer/>", 100))
+    assert store.import_dir("release", cache) == 1
+    assert store.get("release", 1) == Entry(b"<newer/>", 100)
+    two = b"<Group><ID>2</ID><Name>Two</Name></Group>"
+    assert store.get("release", 2) == Entry(two, 5.0)
+    assert store.find_name("group", "two") == [2]
+
+
+def test_pages(tmp_path: Path):
+    store = MetaStore(tmp_path / "meta.sqlite")
+    assert store.get_page("search", "groups/x") is None
+    store.put_page("search", "groups/x", 10, "[1, 2]")
+    store.put_page("search", "groups/x", 20, "[3]")
+    assert store.get_page("search", "groups/x") == ("[3]", 20)
+    assert store.get_page("toplist", "groups/x") is None
+
+
+def test_names(tmp_path: Path):
+    store = MetaStore(tmp_path / "meta.sqlite")
+    xml = Path("testdata/release.xml").read_bytes()
+    assert extract_names(xml) == {
+        ("release", "edge of disgrace", 72550),
+        ("event", "x'2008", 1410),
+        ("group", "booze design", 1003),
+    }
+    store.put("release", 72550, Entry(xml, 0))
+    group = b"<CSDbData><Group><ID>2</ID><Name>Booze &amp; Co</Name></Group></CSDbData>"
+    assert store.index_names("pack", "1", [group])
+    assert not store.index_names("pack", "1", [b"<Group><ID>3</ID><Name>X</Name>"])
+
+    assert store.find_name("group", "Booze  DESIGN") == [1003]
+    assert store.find_name("group", "booze") == [2, 1003]
+    assert store.find_name("group", "Boze Design") == []
+    assert store.similar_names("group", "Boze Design") == ["booze design"]
+    assert store.similar_names("group", "Booze Design Crew") == ["booze design"]
+    assert store.similar_names("group", "Fairlight") == []
+    assert store.find_name("group", "booze & co") == [2]
+    assert store.find_name("group", "Edge of Disgrace") == []
+    assert store.find_name("event", "x") == [1410]
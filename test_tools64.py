@@ -1,5 +1,12 @@
+import gzip
+import io
+import tarfile
+import zipfile
 from pathlib import Path
 
+import pytest
+
+import tools64
 from utils import temp_dir
 from tools64 import unpack, Release
 
@@ -22,6 +29,78 @@ def test_unpack():
         unpack(td / "SPACEACA.T64.gz", out)
         assert (out / "SPACEACA.T64").exists()
 
+def test_native_unpack(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    commands: list[str] = []
+    monkeypatch.setattr(tools64, "run", lambda args, **_: commands.append(args[0]))
+    prg = b"\x01\x08" + bytes(100)
+
+    with temp_dir() as out:
+        unpack(Path("testdata/skaaneland.zip"), out)
+        assert (out / "Skaaneland [Side 1].d64").stat().st_size == 174848
+        assert (out / "Skaaneland [Side 2].d64").stat().st_size == 174848
+
+    with zipfile.ZipFile(tmp_path / "dirs.zip", "w") as zf:
+        zf.writestr("demo/part1.prg", prg)
+        zf.writestr("demo/info/read.me", b"hello")
+    with temp_dir() as out:
+        unpack(tmp_path / "dirs.zip", out)
+        assert sorted(p.name for p in out.iterdir()) == ["part1.prg"]
+
+    with tarfile.open(tmp_path / "demo.tgz", "w:gz") as tf:
+        info = tarfile.TarInfo("../demo/part2.prg")
+        info.size = len(prg)
+        tf.addfile(info, io.BytesIO(prg))
+    (tmp_path / "demo.tar.gz").write_bytes((tmp_path / "demo.tgz").read_bytes())
+    for name in ["demo.tgz", "demo.tar.gz"]:
+        with temp_dir() as out:
+            unpack(tmp_path / name, out)
+            assert sorted(p.name for p in out.iterdir()) == ["part2.prg"]
+
+    (tmp_path / "notgz.prg.gz").write_bytes(prg)
+    (tmp_path / "part3.prg.gz").write_bytes(gzip.compress(prg))
+    for name in ["notgz.prg", "part3.prg"]:
+        with temp_dir() as out:
+            unpack(tmp_path / f"{name}.gz", out)
+            assert (out / name).read_bytes() == prg
+    assert commands == []
+
+    # Imploded zips (from PKZIP 1) are left to 7z
+    data = bytearray((tmp_path / "dirs.zip").read_bytes())
+    data[data.find(b"PK\x01\x02") + 10] = 6
+    (tmp_path / "old.zip").write_bytes(data)
+    with temp_dir() as out:
+        unpack(tmp_path / "old.zip", out)
+    assert commands == ["7z"]
+
+
+def test_check_archive(tmp_path: Path):
+    good = Path("testdata/skaaneland.zip")
+    assert tools64.check_archive(good)
+    assert tools64.check_archive(Path("testdata/SPACEACA.T64.gz"))
+    data = bytearray(good.read_bytes())
+    data[100] ^= 0xFF
+    (tmp_path / "bad.zip").write_bytes(data)
+    assert not tools64.check_archive(tmp_path / "bad.zip")
+    gz = Path("testdata/SPACEACA.T64.gz").read_bytes()
+    (tmp_path / "short.gz").write_bytes(gz[: len(gz) // 2])
+    assert not tools64.check_archive(tmp_path / "short.gz")
+    (tmp_path / "error.zip").write_bytes(b"\n<!DOCTYPE html><html>Not found")
+    assert not tools64.check_archive(tmp_path / "error.zip")
+    (tmp_path / "demo.prg").write_bytes(b"\x01\x08" + bytes(100))
+    assert tools64.check_archive(tmp_path / "demo.prg")
+
+
+def test_missing_tool(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+):
+    monkeypatch.setattr(tools64, "missing_tools", set())
+    monkeypatch.setitem(tools64.tools, "no-such-tool", "You need it for tests")
+    assert tools64.run(["no-such-tool", "x"]) != 0
+    assert tools64.run(["no-such-tool", "y"]) != 0
+    out = capsys.readouterr().out
+    assert out == "**Missing** `no-such-tool`. You need it for tests\n"
+
+
 def test_format():
     rel = Release(title="Cowboys", group="Cats", place=3)
     rel2 = Release(title="Cowboys", group="Cats", place=-1, year=1984)
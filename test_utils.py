@@ -1,4 +1,26 @@
-from utils import flatten_dir, remove_in, temp_dir
+import socket
+import threading
+import time
+import urllib.error
+from pathlib import Path
+
+import pytest
+
+import utils
+from conftest import Handler, file_data
+from net import RateLimiter, Session
+from utils import (
+    DirIndex,
+    Journal,
+    collect_garbage,
+    download,
+    flatten_dir,
+    get_cached,
+    hedged_download,
+    remove_in,
+    temp_dir,
+)
+
 
 def test_flatten_dir():
     with temp_dir() as p:
@@ -22,3 +44,174 @@ def test_flatten_dir():
         assert not (p / "a").exists()
         assert not (p / "b").exists()
 
+
+def test_journal(tmp_path: Path):
+    j = Journal(tmp_path / "journal")
+    j.update("a", size=1)
+    j.update("b", size=2)
+    j.update("a", used=5)
+    j.remove("b")
+    with open(tmp_path / "journal", "a") as f:
+        f.write('{"key": "c", "si')
+    j = Journal(tmp_path / "journal")
+    assert j.get("a") == {"size": 1, "used": 5}
+    assert j.get("b") is None and j.get("c") is None
+
+
+def test_dir_index(tmp_path: Path):
+    (tmp_path / "a").touch()
+    index = DirIndex(tmp_path)
+    assert "a" in index and "b" not in index
+    # Only scanned once
+    (tmp_path / "b").touch()
+    assert "b" not in index
+    index.add("b")
+    index.discard("a")
+    assert "a" not in index and "b" in index
+    assert "a" not in DirIndex(tmp_path / "missing")
+
+
+def test_download(server: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+
+    assert download(f"{server}/short.zip") is None
+    assert get_cached(f"{server}/short.zip") is None
+
+    url = f"{server}/file.zip"
+    file = download(url)
+    assert file is not None and file.read_bytes() == file_data
+    assert get_cached(url) == file
+
+    # A truncated cache entry is detected and downloaded again
+    file.write_bytes(file_data[:100])
+    assert get_cached(url) is None
+    file = download(url)
+    assert file is not None and file.read_bytes() == file_data
+
+
+def test_failed_download(server: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+    s = Session(retries=1)
+    s.limiter = RateLimiter(backoff=0.01)
+    monkeypatch.setattr(utils, "session", s)
+
+    url = f"{server}/missing.zip"
+    assert download(url) is None
+    assert download(url) is None
+    assert s.stats.requests == 1
+    rec = utils.failures.get(url)
+    assert rec is not None and rec["error"] == "HTTP 404"
+    assert download("http://no.such.host.invalid/file.zip") is None
+    assert (
+        utils.recent_failure("http://no.such.host.invalid/file.zip") == "Unknown host"
+    )
+    # Temporary name lookup failures (ie when offline) are not remembered
+    again = socket.gaierror(socket.EAI_AGAIN, "Temporary failure in name resolution")
+    assert utils.failure_class(urllib.error.URLError(again)) is None
+
+    # Server errors are not remembered
+    Handler.busy = 100
+    assert download(f"{server}/busy") is None
+    assert utils.recent_failure(f"{server}/busy") is None
+    Handler.busy = 0
+
+    # A cached file that turned out to be useless is not returned again, and
+    # is removed if it is broken
+    file = download(f"{server}/file.zip")
+    assert file is not None
+    utils.mark_failed(f"{server}/file.zip", "Nothing to unpack")
+    assert download(f"{server}/file.zip") is None
+    assert file.exists()
+    utils.mark_failed(f"{server}/file.zip", "Not an archive")
+    assert download(f"{server}/file.zip") is None
+    assert not file.exists()
+
+    utils.set_retry_window(0)
+    requests = s.stats.requests
+    assert download(url) is None
+    assert s.stats.requests == requests + 1
+    utils.mark_failed(f"{server}/file.zip", "Not an archive")
+    assert download(f"{server}/file.zip") is not None
+    assert utils.failures.get(f"{server}/file.zip") is None
+
+
+def test_collect_garbage(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+    releases = tmp_path / "releases"
+    releases.mkdir()
+    for i, name in enumerate(["a", "b", "c", "d"]):
+        (releases / name).write_bytes(b"x" * 100)
+        utils.downloads.update(name, size=100, used=i)
+    utils.downloads.update("a", used=10)
+    utils.pin("b")
+    (releases / "e").write_bytes(b"x" * 50)
+    utils.downloads.update("e", size=100)
+    (releases / "f.part").write_bytes(b"x" * 10)
+    (releases / "g.part").write_bytes(b"x" * 10)
+    utils.downloads.update("g.part", size=100)
+
+    # Broken and orphaned files go first, then least recently used
+    assert collect_garbage(250) == (4, 260, 210)
+    assert sorted(f.name for f in releases.iterdir()) == [
+        ".downloads",
+        "a",
+        "b",
+        "g.part",
+    ]
+    assert utils.downloads.get("c") is None
+    assert get_cached("a") is not None
+    assert collect_garbage(0) == (2, 110, 100)
+    assert collect_garbage() == (0, 0, 100)
+
+
+def test_resume_download(server: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+
+    url = f"{server}/flaky.zip"
+    assert download(url) is None
+    part = utils.cache_file(url).with_name(utils.cache_file(url).name + ".part")
+    assert part.stat().st_size == 1000
+    file = download(url)
+    assert file is not None and file.read_bytes() == file_data
+    assert not part.exists()
+    assert Handler.ranges == ["bytes=1000-"]
+
+    # Server without range support; starts over and fails the same way again
+    url = f"{server}/norange.zip"
+    assert download(url) is None
+    assert download(url) is None
+    assert get_cached(url) is None
+
+
+def test_hedged_download(server: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+
+    urls = [f"{server}/slow.zip", f"{server}/file.zip", f"{server}/other.zip"]
+    start = time.monotonic()
+    file = hedged_download(urls, 0.1, lambda _: True)
+    assert file == utils.cache_file(urls[1])
+    assert time.monotonic() - start < 0.9
+    # The cancelled download cleans up after itself
+    part = Path(f"releases/{utils.cache_file(urls[0]).name}.part")
+    with utils.download_lock(utils.cache_file(urls[0]).name):
+        assert not part.exists()
+        assert utils.downloads.get(part.name) is None
+
+    # The same file is only downloaded by one thread at a time
+    url = f"{server}/slow.zip"
+    results: list[Path | None] = []
+    threads = [
+        threading.Thread(target=lambda: results.append(download(url))) for _ in range(3)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [utils.cache_file(url)] * 3
+    assert utils.cache_file(url).read_bytes() == file_data
+
+    # First finished download is not valid
+    urls = [f"{server}/missing.zip", f"{server}/other.zip", f"{server}/file.zip"]
+    file = hedged_download(urls, 10, lambda f: f.name.endswith("file.zip"))
+    assert file == utils.cache_file(urls[2])
+    assert hedged_download(urls[:1], 0.1, lambda _: True) is None
@@ -1,15 +1,20 @@
 #!/usr/bin/python
 
+import gzip
 import re
 import shutil
 import subprocess
+import tarfile
 import urllib
 import urllib.parse
+import zipfile
+import zlib
 from contextlib import contextmanager
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Generator
 
+import d64
 from utils import dospath, fat32names, fixname, flatten_dir, remove_in
 
 is_win = False
@@ -135,7 +140,27 @@ def show_run_output(show: bool):
     global show_output
     show_output = show
 
+# External tools, and what they are needed for
+tools = {
+    "7z": "You need it to unpack old zip files and 7z archives",
+    "unrar": "You need it to unpack rar files",
+    "lha": "You need it to unpack lha and lzh files",
+    "tar": "You need it to unpack tar files that Python can not read",
+    "cbmconvert": "You need it to convert T64 and Lynx files",
+    "zip2disk": "You need it to convert C64-zip to d64",
+}
+
+# Tools we have already told the user are missing
+missing_tools: set[str] = set()
+
+
 def run(args: list[str | Path], cwd: Path | None = None, nostderr: bool = False) -> int:
+    tool = str(args[0])
+    if shutil.which(tool) is None:
+        if tool not in missing_tools:
+            missing_tools.add(tool)
+            print(f"**Missing** `{tool}`. {tools.get(tool, '')}")
+        return 127
     err = subprocess.DEVNULL if nostderr else None
     out = None if show_output else subprocess.DEVNULL
     if cwd is not None:
@@ -162,6 +187,119 @@ keep = {
 }
 
 
+def gunzip(file: Path, target: Path) -> bool:
+    """
+    Decompress `file` to `target`. Returns False, leaving no `target`, if
+    `file` turns out to not be gzipped.
+    """
+    try:
+        with gzip.open(file) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        return True
+    except (gzip.BadGzipFile, EOFError, zlib.error):
+        target.unlink(missing_ok=True)
+        return False
+
+
+def extract_zip(archive: Path, targetdir: Path) -> bool:
+    """
+    Extract all files in `archive` directly into `targetdir`, like `7z e`.
+    Returns False if it needs to be done by 7z instead (old compression
+    methods, encryption or a broken archive).
+    """
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                name = info.filename.replace("\\", "/").split("/")[-1]
+                if info.is_dir() or name in ("", ".", ".."):
+                    continue
+                with zf.open(info) as src, open(targetdir / name, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+        return True
+    except (
+        zipfile.BadZipFile,
+        NotImplementedError,
+        RuntimeError,
+        EOFError,
+        zlib.error,
+    ):
+        return False
+
+
+def extract_tar(archive: Path, targetdir: Path) -> bool:
+    """
+    Extract the files in `archive` (possibly compressed) to `targetdir`.
+    Links and other special files are skipped. Returns False if it needs
+    to be done by tar instead.
+    """
+    try:
+        with tarfile.open(archive) as tf:
+            for member in tf:
+                parts = [p for p in member.name.split("/") if p not in ("", ".", "..")]
+                if not member.isfile() or not parts:
+                    continue
+                target = targetdir.joinpath(*parts)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                src = tf.extractfile(member)
+                assert src is not None
+                with src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+        return True
+    except (tarfile.TarError, EOFError, zlib.error):
+        return False
+
+
+# Archives we can extract without external tools
+native_formats = {".ZIP": extract_zip, ".TAR": extract_tar, ".TGZ": extract_tar}
+
+
+def check_archive(file: Path) -> bool:
+    """
+    Quick check that a download is what it should be. Gzip and zip files
+    must have intact data, tar files readable headers. Anything else is
+    fine unless it is an HTML page (ie an error page from a mirror).
+    """
+    with open(file, "rb") as f:
+        header = f.read(16)
+    try:
+        if header[:2] == b"\x1f\x8b":
+            with gzip.open(file) as gz:
+                while gz.read(1 << 16):
+                    pass
+        elif header[:4] in (b"PK\x03\x04", b"PK\x05\x06"):
+            with zipfile.ZipFile(file) as zf:
+                try:
+                    return zf.testzip() is None
+                except (NotImplementedError, RuntimeError):
+                    # Old compression method or encrypted; 7z will have to tell
+                    return True
+        elif file.suffix.upper() == ".TAR":
+            with tarfile.open(file) as tf:
+                tf.getmembers()
+    except (
+        gzip.BadGzipFile,
+        zipfile.BadZipFile,
+        tarfile.TarError,
+        EOFError,
+        zlib.error,
+    ):
+        return False
+    return not header.lstrip().lower().startswith((b"<!doctype", b"<html"))
+
+
+def extract_with_tool(archive: Path, ext: str, targetdir: Path):
+    if ext == ".ZIP":
+        run(["7z", "e", archive, "-y", f"-o{targetdir}"])
+    elif ext == ".RAR":
+        run(["unrar", "e", "-o-", "-y", archive.absolute()], cwd=targetdir)
+    elif ext == ".TGZ":
+        run(["tar", "-xzf", archive.absolute()], cwd=targetdir)
+    elif ext == ".TAR":
+        run(["tar", "-xf", archive.absolute()], cwd=targetdir)
+    elif ext == ".LHA" or ext == ".LZH":
+        run(["lha", "x", archive.absolute()], cwd=targetdir)
+
+
 def unpack(
     archive: Path,
     targetdir: Path,
@@ -194,26 +332,18 @@ def unpack(
     while True:
         file_name = get_filename(archive)
         if ext == ".GZ":
-            # Gzip replaces original file so copy it to targetdir first
-            shutil.copyfile(archive, targetdir / file_name)
-            archive = targetdir / file_name
-            if run(["gzip", "-d", archive]):
+            target = (targetdir / file_name).with_suffix("")
+            if not gunzip(archive, target):
                 # Sometimes gzip files aren't.
-                archive.rename(archive.with_suffix(""))
-            archive = archive.with_suffix("")
+                shutil.copyfile(archive, target)
+            archive = target
             ext = archive.suffix.upper()
 
-        if ext == ".ZIP":
-            # subprocess.call(["unzip", "-n", "-j", archive, "-d", targetdir])
-            run(["7z", "e", archive, "-y", f"-o{targetdir}"])
-        elif ext == ".RAR":
-            run(["unrar", "e", "-o-", "-y", archive.absolute()], cwd=targetdir)
-        elif ext == ".TGZ":
-            run(["tar", "-xzf", archive.absolute()], cwd=targetdir)
-        elif ext == ".TAR":
-            run(["tar", "-xf", archive.absolute()], cwd=targetdir)
-        elif ext == ".LHA" or ext == ".LZH":
-            run(["lha", "x", archive.absolute()], cwd=targetdir)
+        if ext in (".ZIP", ".RAR", ".TGZ", ".TAR", ".LHA", ".LZH"):
+            extract = native_formats.get(ext)
+            if extract is None or not extract(archive, targetdir):
+                log(f"Extracting {file_name} with external tool")
+                extract_with_tool(archive, ext, targetdir)
         else:
             with open(archive, "rb") as af:
                 header = af.read(8)
@@ -239,7 +369,8 @@ def unpack(
         if r.is_dir():
             continue
         if ext == ".GZ":
-            run(["gunzip", r])
+            if gunzip(r, r.with_suffix("")):
+                r.unlink()
         elif r.name[:2] == "1!":
             run(["zip2disk", r.name[2:]], cwd=targetdir)
             for f in targetdir.glob(f"?!{r.name[2:]}"):
@@ -274,33 +405,33 @@ def unpack(
 
     # Unpack D64 to PRG if requested
     if d64_to_prg:
-        for r in targetdir.iterdir():
+        for r in list(targetdir.iterdir()):
             if r.suffix.upper() == ".D64":
-                rc = run(["cbmconvert", "-N", "-d", r.name], cwd=targetdir, nostderr=True)
-                if rc != 0:
-                   log(f"cbmconvert returned {rc} for {r.name}")
-                foundprog = False
-                for r2 in targetdir.iterdir():
-                    ext = r2.suffix.upper()
-                    if ext == ".DEL" or ext == ".USR":
-                        r2.unlink()
-                    elif ext == ".PRG":
-                        foundprog = True
+                try:
+                    d64.extract(r, targetdir)
+                except ValueError as e:
+                    log(f"Could not read {r.name}: {e}")
+                foundprog = any(
+                    r2.suffix.upper() == ".PRG" for r2 in targetdir.iterdir()
+                )
                 if foundprog:
                     r.unlink()
 
     # Put all unpacked PRG into a d64 if requested
     elif prg_to_d64:
-        progs: list[str] = []
-        for r in targetdir.iterdir():
-            if r.suffix.upper() == ".PRG":
-                progs.append(r.name)
+        progs = sorted(r for r in targetdir.iterdir() if r.suffix.upper() == ".PRG")
         if progs:
             file_name = get_filename(archive.with_suffix(".d64"))
-            #print(f"Putting {progs} into {n}")
-            subprocess.call(["cbmconvert", "-n", "-D4", file_name] + progs, cwd=targetdir)
-            for p in progs:
-                (targetdir / p).unlink()
+            disk = d64.D64Writer(d64.petscii(Path(file_name).stem))
+            try:
+                for p in progs:
+                    disk.add(d64.petscii(p.stem), p.read_bytes())
+            except ValueError as e:
+                log(f"Could not put {len(progs)} programs in {file_name}: {e}")
+            else:
+                (targetdir / file_name).write_bytes(disk.finish())
+                for p in progs:
+                    p.unlink()
 
     for r in targetdir.iterdir():
         ext = r.suffix.upper()
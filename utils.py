@@ -1,12 +1,26 @@
 #!/usr/bin/python
 
+import functools
+import http.client
+import json
+import os
+import queue
+import re
+import socket
+import threading
+import time
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Generator
-import urllib.request
+from typing import Any, Callable, Generator
 import urllib.parse
 import urllib.error
 
+from net import Response, session
+
+chunk_size = 1 << 16
+
+content_range = re.compile(r"bytes (\d+)-\d+/(\d+)")
+
 
 @contextmanager
 def temp_dir(show: bool = False) -> Generator[Path, None, None]:
@@ -122,32 +136,464 @@ def reorganize(root_dir: Path, max_files: int, min_files: int = -1):
 # reorganize(Path("Games"), 250, 50)
 
 
-def get_cached(url: str) -> Path | None:
+def parse_age(text: str) -> float:
+    """Parse a time span like `90`, `45m`, `12h` or `7d` into seconds"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+    text = text.strip().lower()
+    if text[-1:] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def parse_size(text: str) -> int:
+    """Parse a size like `500`, `64k`, `100M` or `2G` into bytes"""
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+    text = text.strip().lower().removesuffix("b")
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    """Format a size in bytes like `512`, `64.0K` or `1.5G`"""
+    value = float(size)
+    for unit in ["", "K", "M", "G"]:
+        if value < 1024:
+            return f"{value:.1f}{unit}" if unit else str(size)
+        value /= 1024
+    return f"{value:.1f}T"
+
+
+def write_atomic(path: Path, data: bytes):
+    """Write `data` to a temp file next to `path` and rename it into place"""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+class Journal:
+    """
+    Persistent key -> record mapping, stored as an append only file of JSON
+    lines where later lines update earlier ones. A torn last line (from a
+    killed process) is simply ignored.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records: dict[str, dict[str, Any]] | None = None
+        self.lines = 0
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        if self.records is None:
+            self.records = {}
+            if self.path.exists():
+                for line in self.path.read_text().splitlines():
+                    try:
+                        rec: dict[str, Any] = json.loads(line)
+                        key: str = rec.pop("key")
+                    except (ValueError, KeyError):
+                        continue
+                    self.lines += 1
+                    if rec.get("removed"):
+                        self.records.pop(key, None)
+                    else:
+                        self.records.setdefault(key, {}).update(rec)
+        return self.records
+
+    def _append(self, rec: dict[str, Any]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(rec) + "\n")
+        self.lines += 1
+        records = self._load()
+        if self.lines > 2 * len(records) + 1000:
+            self._compact(records)
+
+    def _compact(self, records: dict[str, dict[str, Any]]):
+        lines = [json.dumps({"key": key} | rec) + "\n" for key, rec in records.items()]
+        write_atomic(self.path, "".join(lines).encode())
+        self.lines = len(lines)
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        with self.lock:
+            return self._load().get(key)
+
+    def update(self, key: str, **fields: Any):
+        with self.lock:
+            self._load().setdefault(key, {}).update(fields)
+            self._append({"key": key} | fields)
+
+    def remove(self, key: str):
+        with self.lock:
+            if self._load().pop(key, None) is not None:
+                self._append({"key": key, "removed": True})
+
+
+class DirIndex:
+    """
+    Names of the files in a directory. The directory is scanned once, the
+    first time it is needed, and after that the index is kept up to date
+    by whoever adds or removes files, so lookups never touch the disk.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.names: set[str] | None = None
+
+    def _load(self) -> set[str]:
+        if self.names is None:
+            try:
+                with os.scandir(self.path) as it:
+                    self.names = {e.name for e in it}
+            except FileNotFoundError:
+                self.names = set()
+        return self.names
+
+    def __contains__(self, name: str) -> bool:
+        with self.lock:
+            return name in self._load()
+
+    def add(self, name: str):
+        with self.lock:
+            self._load().add(name)
+
+    def discard(self, name: str):
+        with self.lock:
+            self._load().discard(name)
+
+
+# Download size for every file in `releases/`, to detect broken files
+downloads = Journal(Path("releases/.downloads"))
+
+# Files in `releases/`
+cached_files = DirIndex(Path("releases"))
+
+# Files in `releases/` needed by the current run, which are never evicted
+pinned: set[str] = set()
+
+# Downloads that failed in a way that is not likely to change soon; the
+# file is gone, the host doesn't exist or it is not an archive we can use
+failures = Journal(Path("releases/.failed"))
+
+# Seconds until something that failed like that is tried again
+retry_window: float = 7 * 86400
+
+# Name lookup errors that mean the host doesn't exist; others (like
+# EAI_AGAIN when offline) are temporary
+unknown_host = {
+    socket.EAI_NONAME,
+    getattr(socket, "EAI_NODATA", socket.EAI_NONAME),
+}
+
+
+@functools.cache
+def cache_file(url: str) -> Path:
     t = urllib.parse.unquote_plus(url)
     name = urllib.parse.quote_plus(t)
-    file_name = Path(f"releases/{name}")
-    if file_name.exists():
-        return file_name
+    return Path(f"releases/{name}")
+
+
+def get_cached(url: str) -> Path | None:
+    file_name = cache_file(url)
+    if file_name.name not in cached_files:
+        return None
+    try:
+        size = file_name.stat().st_size
+    except FileNotFoundError:
+        cached_files.discard(file_name.name)
+        return None
+    rec = downloads.get(file_name.name)
+    if rec is not None and rec.get("size", size) != size:
+        print(f"Removing broken download {file_name.name}")
+        remove_cached(file_name.name)
+        return None
+    downloads.update(file_name.name, used=time.time())
+    return file_name
+
+
+def set_retry_window(age: float):
+    global retry_window
+    retry_window = age
+
+
+def failed_recently(failed: float) -> bool:
+    """Should something that failed at time `failed` still be skipped"""
+    return time.time() - failed < retry_window
+
+
+def failure_class(e: Exception) -> str | None:
+    """Describe download error `e`, if it is one that should be remembered"""
+    if isinstance(e, urllib.error.HTTPError):
+        return f"HTTP {e.code}" if e.code in (404, 410) else None
+    if isinstance(e, urllib.error.URLError) and isinstance(e.reason, socket.gaierror):
+        return "Unknown host" if e.reason.errno in unknown_host else None
     return None
 
 
-def download(url: str) -> Path | None:
-    t = urllib.parse.unquote_plus(url)
-    name = urllib.parse.quote_plus(t)
-    file_name = Path(f"releases/{name}")
+def mark_failed(url: str, error: str):
+    failures.update(url, failed=time.time(), error=error)
+
+
+def recent_failure(url: str) -> str | None:
+    """The error `url` failed with, if it should not be tried again yet"""
+    rec = failures.get(url)
+    if rec is not None and failed_recently(rec["failed"]):
+        return rec["error"]
+    return None
+
+
+def pin(url: str):
+    """Keep the download of `url` in the cache for the rest of this run"""
+    pinned.add(cache_file(url).name)
+
+
+def remove_cached(name: str):
+    Path("releases", name).unlink(missing_ok=True)
+    cached_files.discard(name)
+    downloads.remove(name)
+
+
+def collect_garbage(max_size: int | None = None) -> tuple[int, int, int]:
+    """
+    Clean up `releases/`; remove `.part` files that can not be resumed and
+    downloads that don't have the expected size. Then, if `max_size` is
+    given, remove the least recently used downloads until the cache fits
+    within it. Pinned files are left alone.
+
+    Returns number of files removed, bytes freed and bytes left.
+    """
+    files: list[tuple[float, int, str]] = []
+    total = removed = freed = 0
+    try:
+        entries = list(os.scandir("releases"))
+    except FileNotFoundError:
+        return 0, 0, 0
+    for e in entries:
+        if e.name.startswith(".") or not e.is_file():
+            continue
+        size = e.stat().st_size
+        rec = downloads.get(e.name)
+        if e.name.endswith(".part"):
+            broken = rec is None
+        else:
+            broken = rec is not None and rec.get("size", size) != size
+        if broken and e.name not in pinned:
+            remove_cached(e.name)
+            removed += 1
+            freed += size
+            continue
+        total += size
+        if e.name not in pinned:
+            used = rec.get("used") if rec is not None else None
+            files.append((used or e.stat().st_mtime, size, e.name))
+    if max_size is not None:
+        for _, size, name in sorted(files):
+            if total <= max_size:
+                break
+            remove_cached(name)
+            removed += 1
+            freed += size
+            total -= size
+    return removed, freed, total
+
+
+class Cancelled(Exception):
+    pass
+
+
+# One lock per file in `releases/`, so the same file is never downloaded by
+# two threads at once
+download_locks: dict[str, threading.Lock] = {}
+download_locks_lock = threading.Lock()
+
+
+def download_lock(name: str) -> threading.Lock:
+    with download_locks_lock:
+        return download_locks.setdefault(name, threading.Lock())
+
+
+def _save(
+    resp: Response,
+    target: Path,
+    mode: str,
+    cancel: threading.Event | None,
+    started: threading.Event | None,
+):
+    with open(target, mode) as f:
+        while chunk := resp.read(chunk_size):
+            f.write(chunk)
+            if started is not None:
+                started.set()
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+
+
+def _fetch_part(
+    url: str,
+    part: Path,
+    cancel: threading.Event | None = None,
+    started: threading.Event | None = None,
+) -> int | None:
+    """
+    Fetch `url` into `part`, resuming from what is already there if we know
+    the expected size and the server supports ranges.
+    Returns the expected size of the complete file, if known.
+    """
+    rec = downloads.get(part.name)
+    offset = part.stat().st_size if rec is not None and part.exists() else 0
+    headers: dict[str, str] = {}
+    if rec is not None and offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+        validator = rec.get("etag") or rec.get("modified")
+        if validator:
+            headers["If-Range"] = validator
+    try:
+        resp = session.open(url, headers)
+    except urllib.error.HTTPError as e:
+        if e.code != 416 or offset == 0:
+            raise
+    else:
+        with resp:
+            if resp.status != 206:
+                length = resp.headers.get("Content-Length")
+                total = int(length) if length is not None and length.isdigit() else None
+                if total is None:
+                    downloads.remove(part.name)
+                else:
+                    etag = resp.headers.get("ETag")
+                    modified = resp.headers.get("Last-Modified")
+                    downloads.update(
+                        part.name, size=total, etag=etag, modified=modified
+                    )
+                _save(resp, part, "wb", cancel, started)
+                return total
+            m = content_range.match(resp.headers.get("Content-Range", ""))
+            if (
+                rec is not None
+                and m
+                and int(m[1]) == offset
+                and int(m[2]) == rec["size"]
+            ):
+                print(f"Resuming {part.name} at {offset} bytes")
+                _save(resp, part, "ab", cancel, started)
+                return rec["size"]
+    if offset == 0:
+        raise urllib.error.URLError(f"Unexpected partial response for {url}")
+    # Range was not satisfiable or not what we asked for; start over
+    downloads.remove(part.name)
+    part.unlink()
+    return _fetch_part(url, part, cancel, started)
+
+
+def download(
+    url: str,
+    cancel: threading.Event | None = None,
+    started: threading.Event | None = None,
+) -> Path | None:
+    """
+    Download `url` into the `releases/` cache, unless already there.
+
+    The data is streamed to a `.part` file which is renamed into place once
+    it is complete. If the download fails, the `.part` file is kept and the
+    download will be resumed next time.
+
+    `started` is set when the first data arrives. Setting `cancel` aborts
+    the download and removes the `.part` file.
+    """
+    file_name = cache_file(url)
     file_name.parent.mkdir(exist_ok=True)
-    if not file_name.exists():
-        try:
-            print(f"Downloading {url}")
-            data = urllib.request.urlopen(url.replace(" ", "%20")).read()
-            file_name.write_bytes(data)
-        except urllib.error.HTTPError:
-            return None
-        except urllib.error.URLError:
-            return None
+    with download_lock(file_name.name):
+        return _download(url, file_name, cancel, started)
+
+
+def _download(
+    url: str,
+    file_name: Path,
+    cancel: threading.Event | None,
+    started: threading.Event | None,
+) -> Path | None:
+    if cancel is not None and cancel.is_set():
+        return None
+    error = recent_failure(url)
+    if error is not None:
+        # Also if we have it; it may be a file we could not use
+        print(f"Skipping {url} ({error})")
+        if error == "Not an archive" and file_name.name in cached_files:
+            remove_cached(file_name.name)
+        return None
+    if get_cached(url) is not None:
+        return file_name
+    part = file_name.with_name(file_name.name + ".part")
+    try:
+        print(f"Downloading {url}")
+        total = _fetch_part(url.replace(" ", "%20"), part, cancel, started)
+    except (urllib.error.URLError, http.client.HTTPException, OSError, Cancelled) as e:
+        if isinstance(e, Cancelled) or downloads.get(part.name) is None:
+            remove_cached(part.name)
+        error = failure_class(e)
+        if error is not None:
+            mark_failed(url, error)
+        return None
+    size = part.stat().st_size
+    if total is not None and size != total:
+        if size > total:
+            downloads.remove(part.name)
+            part.unlink()
+        return None
+    os.replace(part, file_name)
+    cached_files.add(file_name.name)
+    downloads.remove(part.name)
+    downloads.update(file_name.name, size=size, used=time.time())
+    failures.remove(url)
     return file_name
 
 
+def hedged_download(
+    urls: list[str], delay: float, valid: Callable[[Path], bool]
+) -> Path | None:
+    """
+    Download from the first of `urls` that gives a valid file, trying
+    several in parallel. If no running download has received any data within
+    `delay` seconds, or one of them fails, the next url is started.
+
+    Finished downloads are checked with `valid` in the calling thread, and
+    once one passes the others are cancelled. They stop and remove their
+    `.part` files when the next data arrives (or they time out), without
+    holding up the winner.
+    """
+    cancel = threading.Event()
+    done: queue.Queue[tuple[int, Path | None]] = queue.Queue()
+    started: list[threading.Event] = []
+    running: set[int] = set()
+
+    def start():
+        i = len(started)
+        started.append(threading.Event())
+        running.add(i)
+        threading.Thread(
+            target=lambda: done.put((i, download(urls[i], cancel, started[i]))),
+            daemon=True,
+        ).start()
+
+    result: Path | None = None
+    while result is None:
+        if len(started) < len(urls) and not any(started[i].is_set() for i in running):
+            start()
+        if not running:
+            break
+        try:
+            i, file = done.get(timeout=delay if len(started) < len(urls) else None)
+        except queue.Empty:
+            continue
+        running.discard(i)
+        if file is not None and valid(file):
+            result = file
+    cancel.set()
+    return result
+
+
 def remove_in(path: Path):
     for r in path.iterdir():
         if r.is_dir():